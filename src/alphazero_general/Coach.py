@@ -1,13 +1,14 @@
 import logging
 import os
+import shutil
 import sys
-from collections import deque
-from pickle import Pickler, Unpickler
-from random import shuffle
-import numpy as np
+import threading
+from pickle import Unpickler
 from tqdm import tqdm
-from alphazero_general.Arena import Arena
-from alphazero_general.MCTS import MCTS
+from alphazero_general.Gatekeeper import Gatekeeper, isAccepted, pitNetworks
+from alphazero_general.MCTS import newMCTS
+from alphazero_general.ReplayBuffer import ReplayBuffer
+from alphazero_general.SelfPlay import SelfPlayWorkers, executeEpisode
 
 log = logging.getLogger(__name__)
 
@@ -23,51 +24,27 @@ class Coach:
         self.nnet = nnet
         self.pnet = self.nnet.__class__(self.game)  # the competitor network
         self.args = args
-        self.mcts = MCTS(self.game, self.nnet, self.args)
-        self.trainExamplesHistory = []  # history of examples from args.numItersForTrainExamplesHistory latest iterations
+        self.mcts = newMCTS(self.game, self.nnet, self.args)
+        # examples from args.numItersForTrainExamplesHistory latest iterations, kept in checkpoint/replay. The
+        # examples left there by an earlier run are only kept when load_examples loads them from that folder
+        folder = os.path.join(self.args.checkpoint, 'replay')
+        resume = self.args.get('load_examples', False) and os.path.realpath(folder) == os.path.realpath(
+            os.path.join(self.args.load_folder_file[0], 'replay'))
+        self.replayBuffer = ReplayBuffer(folder, self.args.numItersForTrainExamplesHistory, self.args.maxlenOfQueue,
+                                         resume=resume)
         self.skipFirstSelfPlay = False  # can be overriden in loadTrainExamples()
+        self.selfPlayWorkers = None  # started on the first parallel self-play
+        self.selfPlayVersion = 0  # bumped every time a new model is accepted
 
     def executeEpisode(self):
         """
-        This function executes one episode of self-play, starting with player 1.
-        As the game is played, each turn is added as a training example to
-        trainExamples. The game is played till the game ends. After the game
-        ends, the outcome of the game is used to assign values to each example
-        in trainExamples.
-
-        It uses a temp=1 if episodeStep < tempThreshold, and thereafter
-        uses temp=0.
-
-        Returns:
-            trainExamples: a list of examples of the form (canonicalBoard, currPlayer, pi,v)
-                           pi is the MCTS informed policy vector, v is +1 if
-                           the player eventually won the game, else -1.
+        Executes one episode of self-play with self.mcts, see
+        SelfPlay.executeEpisode.
         """
-        trainExamples = []
-        board = self.game.getInitBoard()
-        self.curPlayer = 1
-        episodeStep = 0
-
-        while True:
-            episodeStep += 1
-            canonicalBoard = self.game.getCanonicalForm(board, self.curPlayer)
-            temp = int(episodeStep < self.args.tempThreshold)
-
-            pi = self.mcts.getActionProb(canonicalBoard, temp=temp)
-            sym = self.game.getSymmetries(canonicalBoard, pi)
-            for b, p in sym:
-                trainExamples.append([b, self.curPlayer, p, None])
-
-            action = np.random.choice(len(pi), p=pi)
-            board, self.curPlayer = self.game.getNextState(board, self.curPlayer, action)
-
-            r = self.game.getGameEnded(board, self.curPlayer)
-
-            if r != 0:
-                return [(x[0], x[2], r * ((-1) ** (x[1] != self.curPlayer))) for x in trainExamples]
+        return executeEpisode(self.game, self.mcts, self.args)
 
     def pEpisode(self):
-        self.mcts = MCTS(self.game, self.nnet, self.args)
+        self.mcts = newMCTS(self.game, self.nnet, self.args)
         return self.executeEpisode()
 
     def learn(self):
@@ -79,95 +56,212 @@ class Coach:
         only if it wins >= updateThreshold fraction of games.
         """
 
+        if self.args.get('pipelined', False):
+            return self.learnPipelined()
+
         for i in range(1, self.args.numIters + 1):
             # bookkeeping
             log.info(f'Starting Iter #{i} ...')
-            # examples of the iteration
+            # examples of the iteration, written to the replay buffer as the episodes end
             if not self.skipFirstSelfPlay or i > 1:
-                iterationTrainExamples = deque([], maxlen=self.args.maxlenOfQueue)
-
-                for _ in tqdm(range(self.args.numEps), desc="Self Play"):
-                    self.mcts = MCTS(self.game, self.nnet, self.args)  # reset search tree
-                    iterationTrainExamples += self.executeEpisode()
-
-
-                # pool = mp.Pool(mp.cpu_count()-2)
-                # iterationTrainExamples = pool.map(self.pEpisode, tqdm(range(self.args.numEps), desc="Self Play"))
-                # pool.close()
-                # pool.join()
-                # iterationTrainExamples = imap_unordered_bar(self.pEpisode, range(self.args.numEps))
-
-                # with mp.Pool(mp.cpu_count() - 2) as p:
-                #     list(tqdm(p.imap(self.pEpisode, range(self.args.numEps)), total=self.args.numEps, desc="Self Play"))
+                self.replayBuffer.startChunk()
 
-                # save the iteration examples to the history 
-                self.trainExamplesHistory.append(iterationTrainExamples)
+                if self.args.get('numSelfPlayWorkers', 1) > 1:
+                    if self.selfPlayWorkers is None:
+                        self.selfPlayWorkers = SelfPlayWorkers(self.game, self.nnet, self.args)
+                    episodes = self.selfPlayWorkers.playEpisodes(self.args.numEps, self.selfPlayVersion)
+                    for examples in tqdm(episodes, total=self.args.numEps, desc="Self Play"):
+                        self.replayBuffer.append(examples)
+                else:
+                    for _ in tqdm(range(self.args.numEps), desc="Self Play"):
+                        self.mcts = newMCTS(self.game, self.nnet, self.args)  # reset search tree
+                        self.replayBuffer.append(self.executeEpisode())
 
-            if len(self.trainExamplesHistory) > self.args.numItersForTrainExamplesHistory:
-                log.warning(
-                    f"Removing the oldest entry in trainExamples. len(trainExamplesHistory) = {len(self.trainExamplesHistory)}")
-                self.trainExamplesHistory.pop(0)
-            # backup history to a file
-            # NB! the examples were collected using the model from the previous iteration, so (i-1)  
-            self.saveTrainExamples(i - 1)
+                # keeps the maxlenOfQueue latest examples and drops the oldest iteration if needed
+                self.replayBuffer.finishChunk()
 
-            # shuffle examples before training
-            trainExamples = []
-            for e in self.trainExamplesHistory:
-                trainExamples.extend(e)
-            shuffle(trainExamples)
+            # memory-mapped examples, sampled by the network
+            trainExamples = self.replayBuffer.trainingData()
 
             # training new network, keeping a copy of the old one
             self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
             self.pnet.load_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
-            pmcts = MCTS(self.game, self.pnet, self.args)
 
             self.nnet.train(trainExamples)
-            nmcts = MCTS(self.game, self.nnet, self.args)
 
             log.info('PITTING AGAINST PREVIOUS VERSION')
-            arena = Arena(lambda x: np.random.choice(self.game.getActionSize(), p=pmcts.getActionProb(x, temp=0)),
-                          lambda x: np.random.choice(self.game.getActionSize(), p=nmcts.getActionProb(x, temp=0)),
-                          self.game)
-            # arena = Arena(lambda x: np.argmax(pmcts.getActionProb(x, temp=0)),
-            #               lambda x: np.argmax(nmcts.getActionProb(x, temp=0)), self.game)
-            pwins, nwins, draws = arena.playGames(self.args.arenaCompare)
+            pwins, nwins, draws = pitNetworks(self.game, self.pnet, self.nnet, self.args)
 
             log.info('NEW/PREV WINS : %d / %d ; DRAWS : %d' % (nwins, pwins, draws))
-            if draws > 0 or pwins + nwins == 0 or float(nwins) / (pwins + nwins) < self.args.updateThreshold:
+            if not isAccepted(pwins, nwins, draws, self.args.updateThreshold):
                 log.info('REJECTING NEW MODEL')
                 self.nnet.load_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
             else:
                 log.info('ACCEPTING NEW MODEL')
+                self.selfPlayVersion += 1
                 self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=self.getCheckpointFile(i))
                 self.nnet.save_checkpoint(folder=self.args.checkpoint,
                                           filename=str(self.game) + '_' + str(self.nnet) + '_best.pth.tar')
 
+        if self.selfPlayWorkers is not None:
+            self.selfPlayWorkers.close()
+            self.selfPlayWorkers = None
+
+    def learnPipelined(self):
+        """
+        Performs numIters trainings like learn, with self-play, training and
+        the comparison of the networks running at the same time:
+        - self-play workers keep playing episodes with the latest accepted
+          network, written to the replay buffer by a background thread, with a
+          new chunk every numEps episodes
+        - the trainer trains nnet with the replay buffer every time
+          trainInterval (numEps by default) new episodes were played, and
+          saves it as a candidate checkpoint
+        - a Gatekeeper process pits the candidates against the latest accepted
+          network, and accepts them as learn does. Candidates left waiting
+          while a newer one is ready are skipped.
+
+        nnet keeps training from its own weights when a candidate is rejected.
+        """
+        folder = self.args.checkpoint
+        interval = self.args.get('trainInterval', self.args.numEps)
+
+        self.nnet.save_checkpoint(folder=folder, filename='temp.pth.tar')
+        self.acceptedFile = 'temp.pth.tar'  # checkpoint played by self-play
+        self.episodesPlayed = 0
+        self.selfPlayError = None
+        self.stopSelfPlay = False
+        # guards the replay buffer and the state shared with the self-play thread
+        self.pipeline = threading.Condition()
+
+        gatekeeper = Gatekeeper(self.game, self.nnet, self.args, 'temp.pth.tar')
+        if self.selfPlayWorkers is None:
+            self.selfPlayWorkers = SelfPlayWorkers(self.game, self.nnet, self.args)
+        selfPlay = threading.Thread(target=self.selfPlayLoop, daemon=True)
+        selfPlay.start()
+
+        try:
+            # episodes played at the previous training, a loaded replay buffer is trained with right away
+            trained = -interval if len(self.replayBuffer) else 0
+            for i in range(1, self.args.numIters + 1):
+                while True:
+                    with self.pipeline:
+                        if self.selfPlayError is not None:
+                            raise self.selfPlayError
+                        if self.episodesPlayed >= trained + interval:
+                            trained = self.episodesPlayed
+                            # memory-mapped examples, including those of the chunk being played
+                            trainExamples = self.replayBuffer.trainingData()
+                            break
+                        self.pipeline.wait(timeout=1)
+                    self.collectEvaluations(gatekeeper)
+
+                log.info(f'Training candidate #{i} with {len(trainExamples)} examples ...')
+                self.nnet.train(trainExamples)
+                self.nnet.save_checkpoint(folder=folder, filename=self.getCandidateFile(i))
+                gatekeeper.submit(i, self.getCandidateFile(i))
+                self.collectEvaluations(gatekeeper)
+
+            while gatekeeper.pending:
+                self.collectEvaluations(gatekeeper, timeout=1)
+        finally:
+            with self.pipeline:
+                self.stopSelfPlay = True
+            selfPlay.join()
+            gatekeeper.close()
+            self.selfPlayWorkers.close()
+            self.selfPlayWorkers = None
+
+    def selfPlayLoop(self):
+        """
+        Self-play thread of learnPipelined, writing the episodes of the
+        self-play workers to the replay buffer until stopSelfPlay is set.
+        """
+        def weights():
+            with self.pipeline:
+                return self.selfPlayVersion, (self.args.checkpoint, self.acceptedFile)
+
+        episodes = self.selfPlayWorkers.playContinuously(weights)
+        try:
+            while not self.stopSelfPlay:
+                with self.pipeline:
+                    self.replayBuffer.startChunk()
+                for _ in tqdm(range(self.args.numEps), desc="Self Play"):
+                    examples = next(episodes)
+                    with self.pipeline:
+                        self.replayBuffer.append(examples)
+                        self.episodesPlayed += 1
+                        self.pipeline.notify_all()
+                    if self.stopSelfPlay:
+                        break
+                # keeps the maxlenOfQueue latest examples and drops the oldest chunk if needed
+                with self.pipeline:
+                    self.replayBuffer.finishChunk()
+        except Exception as e:
+            with self.pipeline:
+                self.selfPlayError = e
+                self.pipeline.notify_all()
+        finally:
+            episodes.close()
+
+    def collectEvaluations(self, gatekeeper, timeout=0):
+        """
+        Handles the candidates evaluated by the gatekeeper of learnPipelined,
+        making self-play use the accepted ones.
+        """
+        for i, result in gatekeeper.results(timeout):
+            candidateFile = self.getCandidateFile(i)
+            if result is None:
+                log.info(f'Candidate #{i} skipped for a newer one')
+            else:
+                pwins, nwins, draws, accepted = result
+                log.info('CANDIDATE #%d NEW/PREV WINS : %d / %d ; DRAWS : %d' % (i, nwins, pwins, draws))
+                if accepted:
+                    log.info('ACCEPTING NEW MODEL')
+                    for filename in (self.getCheckpointFile(i),
+                                     str(self.game) + '_' + str(self.nnet) + '_best.pth.tar'):
+                        shutil.copyfile(os.path.join(self.args.checkpoint, candidateFile),
+                                        os.path.join(self.args.checkpoint, filename))
+                    with self.pipeline:
+                        self.acceptedFile = self.getCheckpointFile(i)
+                        self.selfPlayVersion += 1
+                else:
+                    log.info('REJECTING NEW MODEL')
+            os.remove(os.path.join(self.args.checkpoint, candidateFile))
+
+    def getCandidateFile(self, iteration):
+        return 'candidate_' + str(iteration) + '.pth.tar'
+
     def getCheckpointFile(self, iteration):
         return str(self.game) + '_' + str(self.nnet) + '_checkpoint_' + str(iteration) + '.pth.tar'
         # return str(self.game) + '_' + str(self.nnet) + '_checkpoint.pth.tar'
 
-    def saveTrainExamples(self, iteration):
-        folder = self.args.checkpoint
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        filename = os.path.join(folder, self.getCheckpointFile(iteration) + ".examples")
-        with open(filename, "wb+") as f:
-            Pickler(f).dump(self.trainExamplesHistory)
-
     def loadTrainExamples(self):
+        """
+        Adds the examples of the replay buffer in the folder of
+        args.load_folder_file to the replay buffer, or those of the .examples
+        file of the model written by older versions, as iterations older than
+        the ones already in the buffer. When that folder is args.checkpoint and
+        args.load_examples is set, the buffer already resumed its examples.
+        """
+        folder = os.path.join(self.args.load_folder_file[0], 'replay')
         modelFile = os.path.join(self.args.load_folder_file[0], self.args.load_folder_file[1])
         examplesFile = modelFile + ".examples"
-        if not os.path.isfile(examplesFile):
-            log.warning(f'File "{examplesFile}" with trainExamples not found!')
+        if os.path.isdir(folder):
+            log.info("Replay buffer found. Loading it...")
+            if os.path.realpath(folder) != os.path.realpath(self.replayBuffer.folder):
+                self.replayBuffer.importChunks(folder)
+        elif os.path.isfile(examplesFile):
+            log.info("File with trainExamples found. Loading it...")
+            with open(examplesFile, "rb") as f:
+                self.replayBuffer.importHistory(Unpickler(f).load())
+        else:
+            log.warning(f'Replay buffer "{folder}" and file "{examplesFile}" with trainExamples not found!')
             r = input("Continue? [y|n]")
             if r != "y":
                 sys.exit()
-        else:
-            log.info("File with trainExamples found. Loading it...")
-            with open(examplesFile, "rb") as f:
-                self.trainExamplesHistory = Unpickler(f).load()
-            log.info('Loading done!')
+            return
+        log.info(f'Loading done! {len(self.replayBuffer)} examples from {len(self.replayBuffer.chunks)} iterations')
 
-            # examples based on the model were already collected (loaded)
-            self.skipFirstSelfPlay = False
+        # examples based on the model were already collected (loaded)
+        self.skipFirstSelfPlay = False
@@ -72,6 +72,20 @@ class Game():
         """
         pass
 
+    def getEndgameResult(self, canonicalBoard):
+        """
+        Input:
+            canonicalBoard: canonical form of a board where the game has not
+                            ended
+
+        Returns:
+            r: the outcome of the game for player 1 under perfect play, as
+               getGameEnded, when it can be found without a search, or 0.
+               MCTS scores such boards as terminal below the root when
+               endgame_solver is set.
+        """
+        return 0
+
     def getCanonicalForm(self, board, player):
         """
         Input:
@@ -101,6 +115,21 @@ class Game():
         """
         pass
 
+    def getSymmetriesBatch(self, inputs, pis):
+        """
+        Input:
+            inputs: tuple of the stacked float32 arrays of the boards of a
+                    training batch, as returned by getSymmetries
+            pis: float32 policy vectors of the batch
+
+        Returns:
+            inputs, pis: the batch with a random symmetrical form of every
+                         example. Games whose getSymmetries only returns the
+                         board itself apply the symmetries here instead, on
+                         the fly while training.
+        """
+        return inputs, pis
+
     def stringRepresentation(self, board):
         """
         Input:
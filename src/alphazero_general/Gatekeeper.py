@@ -0,0 +1,119 @@
+import logging
+import multiprocessing as mp
+import queue
+
+import numpy as np
+
+from alphazero_general.Arena import Arena
+from alphazero_general.MCTS import newMCTS
+
+log = logging.getLogger(__name__)
+
+
+def isAccepted(pwins, nwins, draws, threshold):
+    """
+    Whether a new network that won nwins games against the previous one, lost
+    pwins and drew draws replaces it: it must win at least threshold of the
+    decided games, and none may be drawn.
+    """
+    return draws == 0 and pwins + nwins > 0 and float(nwins) / (pwins + nwins) >= threshold
+
+
+def pitNetworks(game, pnet, nnet, args):
+    """
+    Plays args.arenaCompare games between the previous network pnet and the
+    new one nnet, returning the wins of pnet, those of nnet and the draws.
+    """
+    pmcts = newMCTS(game, pnet, args)
+    nmcts = newMCTS(game, nnet, args)
+    arena = Arena(lambda x: np.random.choice(game.getActionSize(), p=pmcts.getActionProb(x, temp=0)),
+                  lambda x: np.random.choice(game.getActionSize(), p=nmcts.getActionProb(x, temp=0)),
+                  game)
+    return arena.playGames(args.arenaCompare)
+
+
+def gatekeeperWorker(game, nnet_class, nn_args, args, folder, filename, candidates, results):
+    """
+    Main loop of the gatekeeper process. The best network starts with the
+    weights in folder/filename. Every task is the (id, filename) of a
+    candidate checkpoint in folder, pitted against the best network and
+    adopted in its place if isAccepted. The result is (id, (pwins, nwins,
+    draws, accepted)), or (id, None) for a candidate skipped because a newer
+    one was already queued. None stops the gatekeeper.
+    """
+    import torch
+    torch.set_num_threads(1)
+    np.random.seed()
+
+    best = nnet_class(game, nn_args)
+    best.load_checkpoint(folder=folder, filename=filename)
+    nnet = nnet_class(game, nn_args)
+    while True:
+        task = candidates.get()
+        # only the latest candidate is worth evaluating
+        while task is not None:
+            try:
+                newer = candidates.get(timeout=0.1)
+            except queue.Empty:
+                break
+            results.put((task[0], None))
+            task = newer
+        if task is None:
+            break
+
+        candidate, candidate_file = task
+        nnet.load_checkpoint(folder=folder, filename=candidate_file)
+        pwins, nwins, draws = pitNetworks(game, best, nnet, args)
+        accepted = isAccepted(pwins, nwins, draws, args.updateThreshold)
+        if accepted:
+            best, nnet = nnet, best
+        results.put((candidate, (pwins, nwins, draws, accepted)))
+
+
+class Gatekeeper:
+    """
+    A process pitting the candidate networks published by the trainer against
+    the best network so far, while self-play and training go on. Candidates
+    are checkpoints in args.checkpoint, submitted with submit() and judged in
+    order; results() returns the outcome of the evaluations finished.
+    """
+
+    def __init__(self, game, nnet, args, filename):
+        """
+        filename is the checkpoint in args.checkpoint of the starting best
+        network.
+        """
+        self.pending = 0  # candidates submitted and not reported yet
+
+        ctx = mp.get_context('spawn')
+        self.candidates = ctx.Queue()
+        self.finished = ctx.Queue()
+        self.process = ctx.Process(target=gatekeeperWorker,
+                                   args=(game, nnet.__class__, nnet.nn_args, args, args.checkpoint, filename,
+                                         self.candidates, self.finished),
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, candidate, filename):
+        self.candidates.put((candidate, filename))
+        self.pending += 1
+
+    def results(self, timeout=0):
+        """
+        Returns the (candidate, result) of the evaluations finished, see
+        gatekeeperWorker, waiting up to timeout seconds for the first one.
+        """
+        results = []
+        while self.pending:
+            try:
+                results.append(self.finished.get(timeout=timeout if not results else 0.01))
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('The gatekeeper process died unexpectedly')
+                break
+            self.pending -= 1
+        return results
+
+    def close(self):
+        self.candidates.put(None)
+        self.process.join()
@@ -0,0 +1,270 @@
+import logging
+import multiprocessing as mp
+import queue
+import time
+import traceback
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class SharedSlot:
+    """
+    Shared-memory buffers through which one client exchanges up to capacity
+    encoded boards, and their policies and values, with the inference server.
+    """
+
+    def __init__(self, ctx, game, capacity):
+        boards, walls, values = game.getBoardSize()
+        self.shapes = {
+            'boards': (capacity, boards[2], boards[0], boards[1]),
+            'walls': (capacity, walls[2], walls[0], walls[1]),
+            'values': (capacity, values),
+            'pis': (capacity, game.getActionSize()),
+            'vs': (capacity,),
+        }
+        self.capacity = capacity
+        self.buffers = {k: ctx.RawArray('f', int(np.prod(shape))) for k, shape in self.shapes.items()}
+        self.views = None
+
+    def view(self):
+        """
+        Returns numpy views over the buffers, created in the calling process.
+        """
+        if self.views is None:
+            self.views = {k: np.frombuffer(self.buffers[k], dtype=np.float32).reshape(shape)
+                          for k, shape in self.shapes.items()}
+        return self.views
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['views'] = None
+        return state
+
+
+class InferenceClient:
+    """
+    Takes the place of the network in a self-play worker. predict,
+    predict_batch and predict_encoded send the boards to the inference server
+    and wait for its answer, following the NeuralNet interface. An error of
+    the server is raised by the call waiting for it.
+    """
+
+    def __init__(self, client_id, slot, requests, response, stopped):
+        self.client_id = client_id
+        self.slot = slot
+        self.requests = requests
+        self.response = response
+        self.stopped = stopped  # set once the server process is gone
+
+    def predict(self, board):
+        pis, vs = self.predict_batch([board])
+        return pis[0], vs[:1]
+
+    def predict_batch(self, boards):
+        boards, walls, values = list(zip(*[b.getBoard() for b in boards]))
+        return self.predict_encoded(np.array(boards), np.array(walls), np.array(values))
+
+    def predict_encoded(self, boards, walls, values):
+        slot = self.slot.view()
+        pis, vs = [], []
+        for i in range(0, len(boards), self.slot.capacity):
+            k = min(self.slot.capacity, len(boards) - i)
+            slot['boards'][:k] = boards[i:i + k]
+            slot['walls'][:k] = walls[i:i + k]
+            slot['values'][:k] = values[i:i + k]
+            self.requests.put(('predict', self.client_id, k, time.time()))
+            self.wait()
+            pis.append(slot['pis'][:k].copy())
+            vs.append(slot['vs'][:k].copy())
+        return np.concatenate(pis), np.concatenate(vs)
+
+    def wait(self):
+        while True:
+            try:
+                result = self.response.get(timeout=1)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    raise RuntimeError('The inference server stopped')
+                continue
+            if isinstance(result, Exception):
+                raise result
+            return
+
+
+def serverError():
+    # sent instead of a reply, the exception itself may not be picklable
+    log.exception('Inference server error')
+    return RuntimeError('Inference server error:\n' + traceback.format_exc())
+
+
+def inferenceServer(game, nnet_class, nn_args, batch_size, timeout, threads, requests, control, slots, responses,
+                    stopped):
+    """
+    Main loop of the inference server process. Requests from all clients are
+    merged into batches of up to batch_size boards, waiting at most timeout
+    seconds after the first request of a batch, and evaluated with a single
+    forward pass.
+
+    A failed forward pass or load is answered with the error instead of the
+    result, and the server goes on. stopped is set when the loop exits.
+    """
+    try:
+        serve(game, nnet_class, nn_args, batch_size, timeout, threads, requests, control, slots, responses)
+    finally:
+        stopped.set()
+
+
+def serve(game, nnet_class, nn_args, batch_size, timeout, threads, requests, control, slots, responses):
+    import torch
+    torch.set_num_threads(threads)
+
+    nnet = nnet_class(game, nn_args)
+    views = [slot.view() for slot in slots]
+    stats = {'batches': 0, 'boards': 0, 'requests': 0, 'latency': 0.}
+
+    while True:
+        msg = requests.get()
+        batch = []
+        deferred = []
+        if msg[0] == 'predict':
+            batch.append(msg)
+            size = msg[2]
+            deadline = time.time() + timeout
+            while size < batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    msg = requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if msg[0] == 'predict':
+                    batch.append(msg)
+                    size += msg[2]
+                else:
+                    deferred.append(msg)
+        else:
+            deferred.append(msg)
+
+        if batch:
+            start = time.time()
+            try:
+                boards = torch.from_numpy(np.concatenate([views[c]['boards'][:k] for _, c, k, _ in batch]))
+                walls = torch.from_numpy(np.concatenate([views[c]['walls'][:k] for _, c, k, _ in batch]))
+                values = torch.from_numpy(np.concatenate([views[c]['values'][:k] for _, c, k, _ in batch]))
+                if nn_args.cuda:
+                    boards, walls, values = boards.cuda(), walls.cuda(), values.cuda()
+                nnet.nnet.eval()
+                with torch.no_grad():
+                    pi, v = nnet.nnet(boards, walls, values)
+                pi = torch.exp(pi).data.cpu().numpy()
+                v = v.data.cpu().numpy()[:, 0]
+            except Exception:
+                error = serverError()
+                for _, c, _, _ in batch:
+                    responses[c].put(error)
+                batch = []
+
+            i = 0
+            for _, c, k, sent in batch:
+                views[c]['pis'][:k] = pi[i:i + k]
+                views[c]['vs'][:k] = v[i:i + k]
+                responses[c].put(True)
+                i += k
+                stats['latency'] += start - sent
+            if batch:
+                stats['batches'] += 1
+                stats['boards'] += i
+                stats['requests'] += len(batch)
+
+        for msg in deferred:
+            if msg[0] == 'load':
+                try:
+                    nnet.load_checkpoint(folder=msg[1], filename=msg[2])
+                    control.put(True)
+                except Exception:
+                    control.put(serverError())
+            elif msg[0] == 'stats':
+                batches = max(stats['batches'], 1)
+                control.put({
+                    'batches': stats['batches'],
+                    'mean_batch_size': stats['boards'] / batches,
+                    'batch_fill': stats['boards'] / (batches * batch_size),
+                    'mean_latency_ms': 1000 * stats['latency'] / max(stats['requests'], 1),
+                })
+                stats = {'batches': 0, 'boards': 0, 'requests': 0, 'latency': 0.}
+            elif msg[0] == 'stop':
+                return
+
+
+class InferenceServer:
+    """
+    A process holding the only copy of the network used by num_clients
+    self-play workers. Each worker gets an InferenceClient from client().
+
+    Batching is configured with inferenceBatchSize (maximum boards per forward
+    pass), inferenceTimeout (seconds to wait for a batch to fill) and
+    inferenceThreads (torch threads of the server).
+    """
+
+    def __init__(self, game, nnet, args, num_clients):
+        ctx = mp.get_context('spawn')
+        capacity = max(1, args.get('mcts_batch_size', 1))
+        self.batch_size = args.get('inferenceBatchSize', 64)
+
+        self.slots = [SharedSlot(ctx, game, capacity) for _ in range(num_clients)]
+        self.requests = ctx.Queue()
+        # queues with a timeout, so that nobody waits forever for a dead server
+        self.control = ctx.Queue()
+        self.responses = [ctx.Queue() for _ in range(num_clients)]
+        self.stopped = ctx.Event()
+        self.process = ctx.Process(target=inferenceServer,
+                                   args=(game, nnet.__class__, nnet.nn_args, self.batch_size,
+                                         args.get('inferenceTimeout', 0.005), args.get('inferenceThreads', 1),
+                                         self.requests, self.control, self.slots, self.responses, self.stopped),
+                                   daemon=True)
+        self.process.start()
+
+    def client(self, client_id):
+        return InferenceClient(client_id, self.slots[client_id], self.requests, self.responses[client_id],
+                               self.stopped)
+
+    def isAlive(self):
+        return self.process.is_alive()
+
+    def getControl(self):
+        """
+        Returns the answer of the server to a control message, raising its
+        error if it failed.
+        """
+        while True:
+            try:
+                result = self.control.get(timeout=1)
+            except queue.Empty:
+                if not self.isAlive():
+                    raise RuntimeError('The inference server died unexpectedly')
+                continue
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+    def loadWeights(self, folder, filename):
+        """
+        Makes the server load the weights in folder/filename, returning once
+        they are loaded.
+        """
+        self.requests.put(('load', folder, filename))
+        self.getControl()
+
+    def stats(self):
+        """
+        Returns the batching statistics gathered since the previous call.
+        """
+        self.requests.put(('stats',))
+        return self.getControl()
+
+    def close(self):
+        self.requests.put(('stop',))
+        self.process.join()
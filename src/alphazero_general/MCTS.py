@@ -1,5 +1,6 @@
 import logging
 import math
+from collections import OrderedDict
 
 import numpy as np
 
@@ -8,9 +9,36 @@ EPS = 1e-8
 log = logging.getLogger(__name__)
 
 
+def newMCTS(game, nnet, args):
+    """
+    Returns a new MCTS of the engine selected by args.mcts_engine: 'python'
+    (this module, the default) or 'native' (MCTSNative, for Quoridor).
+    """
+    engine = args.get('mcts_engine', 'python')
+    if engine == 'native':
+        from alphazero_general.MCTSNative import MCTS as NativeMCTS
+        return NativeMCTS(game, nnet, args)
+    if engine != 'python':
+        raise ValueError(f'Unknown mcts_engine {engine!r}')
+    return MCTS(game, nnet, args)
+
+
 class MCTS:
     """
     This class handles the MCTS tree.
+
+    With reuse_tree set (the default), the board given to getActionProb becomes
+    the root of the tree: the boards that can't be reached from it any more are
+    dropped, and the simulations already spent on its subtree are kept.
+
+    With mcts_max_nodes set, at most that many expanded boards are kept: when
+    a new board is expanded the least recently visited ones are evicted. The
+    terminal and solved boards cached in Es and Rs, which are never expanded,
+    are bounded the same way, each cache dropping its least recently used
+    boards beyond max_nodes.
+
+    With endgame_solver set (the default), the boards below the root whose
+    outcome game.getEndgameResult knows are terminal, with that outcome.
     """
 
     def __init__(self, game, nnet, args):
@@ -19,11 +47,18 @@ class MCTS:
         self.args = args
         self.Qsa = {}  # stores Q values for s,a (as defined in the paper)
         self.Nsa = {}  # stores #times edge s,a was visited
-        self.Ns = {}  # stores #times board s was visited
-        self.Ps = {}  # stores initial policy (returned by neural net)
+        self.Ns = OrderedDict()  # stores #times board s was visited, least recently visited first
+        self.Ps = {}  # stores initial policy (returned by neural net) as float32
 
-        self.Es = {}  # stores game.getGameEnded ended for board s
-        self.Vs = {}  # stores game.getValidMoves for board s
+        self.Es = OrderedDict()  # stores game.getGameEnded ended for board s, least recently used first
+        self.Vs = {}  # stores game.getValidMoves for board s packed as a bitset
+        self.Cs = {}  # stores the boards reached from board s
+        self.Rs = OrderedDict()  # stores game.getEndgameResult for board s below the root, least recently used first
+
+        self.reuse_tree = self.args.get('reuse_tree', True)  # keep the subtree of the new root between moves
+        self.max_nodes = self.args.get('mcts_max_nodes', 0)  # maximum number of expanded boards, 0 for no limit
+        self.endgame_solver = self.args.get('endgame_solver', True)
+        self.action_size = self.game.getActionSize()
 
     def getActionProb(self, canonicalBoard, temp=1):
         """
@@ -34,6 +69,9 @@ class MCTS:
             probs: a policy vector where the probability of the ith action is
                    proportional to Nsa[(s,a)]**(1./temp)
         """
+        if self.reuse_tree:
+            self.pruneTree(canonicalBoard)
+
         for i in range(self.args.numMCTSSims):
             self.search(canonicalBoard)
 
@@ -52,7 +90,58 @@ class MCTS:
 
         return probs
 
-    def search(self, canonicalBoard):
+    def pruneTree(self, canonicalBoard):
+        """
+        Makes canonicalBoard the root of the tree, dropping the boards that
+        can't be reached from it.
+        """
+        root = self.game.stringRepresentation(canonicalBoard)
+        keep = {root}
+        frontier = [root]
+        while frontier:
+            for child in self.Cs.get(frontier.pop(), ()):
+                if child not in keep:
+                    keep.add(child)
+                    frontier.append(child)
+
+        self.Qsa = {k: q for k, q in self.Qsa.items() if k[0] in keep}
+        self.Nsa = {k: n for k, n in self.Nsa.items() if k[0] in keep}
+        self.Ns = OrderedDict((s, n) for s, n in self.Ns.items() if s in keep)
+        for name in ('Ps', 'Vs', 'Cs'):
+            setattr(self, name, {s: x for s, x in getattr(self, name).items() if s in keep})
+        for name in ('Es', 'Rs'):
+            setattr(self, name, OrderedDict((s, x) for s, x in getattr(self, name).items() if s in keep))
+
+    def validActions(self, s):
+        """
+        Returns the list of valid actions of the expanded board s.
+        """
+        return np.flatnonzero(np.unpackbits(self.Vs[s], count=self.action_size)).tolist()
+
+    def evict(self):
+        """
+        Drops the least recently visited boards until at most max_nodes are
+        left.
+        """
+        while len(self.Ns) > self.max_nodes:
+            s, _ = self.Ns.popitem(last=False)
+            for a in self.validActions(s):
+                self.Qsa.pop((s, a), None)
+                self.Nsa.pop((s, a), None)
+            del self.Ps[s], self.Vs[s], self.Cs[s]
+            self.Es.pop(s, None)
+            self.Rs.pop(s, None)
+
+    def remember(self, cache, s, value):
+        """
+        Stores value for board s in cache, Es or Rs, dropping its least
+        recently used boards beyond max_nodes.
+        """
+        cache[s] = value
+        if self.max_nodes and len(cache) > self.max_nodes:
+            cache.popitem(last=False)
+
+    def search(self, canonicalBoard, root=True):
         """
         This function performs one iteration of MCTS. It is recursively called
         till a leaf node is found. The action chosen at each node is one that
@@ -74,12 +163,24 @@ class MCTS:
 
         s = self.game.stringRepresentation(canonicalBoard)
 
-        if s not in self.Es:
-            self.Es[s] = self.game.getGameEnded(canonicalBoard, 1)
+        if s in self.Es:
+            self.Es.move_to_end(s)
+        else:
+            self.remember(self.Es, s, self.game.getGameEnded(canonicalBoard, 1))
         if self.Es[s] != 0:
             # terminal node
             return -self.Es[s]
 
+        if self.endgame_solver and not root:
+            # the root still needs visits to choose a move
+            if s in self.Rs:
+                self.Rs.move_to_end(s)
+            else:
+                self.remember(self.Rs, s, self.game.getEndgameResult(canonicalBoard))
+            if self.Rs[s] != 0:
+                # solved node
+                return -self.Rs[s]
+
         if s not in self.Ps:
             # leaf node
             self.Ps[s], v = self.nnet.predict(canonicalBoard)
@@ -104,36 +205,43 @@ class MCTS:
                 if valids[i] > 0:
                     self.Ps[s][i] = (1 - self.args.eps) * p + self.args.eps * noise[j]
                     j += 1
+            self.Ps[s] = self.Ps[s].astype(np.float32)
 
-            self.Vs[s] = valids
+            self.Vs[s] = np.packbits(valids)
             self.Ns[s] = 0
+            self.Cs[s] = set()
+            if self.max_nodes and len(self.Ns) > self.max_nodes:
+                self.evict()
             return -v
 
-        valids = self.Vs[s]
+        self.Ns.move_to_end(s)  # keeps the boards of the current path out of reach of evict
         cur_best = -float('inf')
         best_act = -1
         # pick the action with the highest upper confidence bound
-        for a in range(self.game.getActionSize()):
-            if valids[a]:
-                if (s, a) in self.Qsa:
-                    cpuct = self.args.cpuct_mult * math.log(
-                        (1 + self.Ns[s] + self.args.cpuct_base) / self.args.cpuct_base) + self.args.cpuct
-                    u = self.Qsa[(s, a)] + cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s]) / (
-                            1 + self.Nsa[(s, a)])
-                else:
-                    cpuct = self.args.cpuct_mult * math.log(
-                        (1 + self.Ns[s] + self.args.cpuct_base) / self.args.cpuct_base) + self.args.cpuct
-                    u = cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s] + EPS)  # Q = 0 ?
-
-                if u > cur_best:
-                    cur_best = u
-                    best_act = a
+        for a in self.validActions(s):
+            if (s, a) in self.Qsa:
+                cpuct = self.args.cpuct_mult * math.log(
+                    (1 + self.Ns[s] + self.args.cpuct_base) / self.args.cpuct_base) + self.args.cpuct
+                u = self.Qsa[(s, a)] + cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s]) / (
+                        1 + self.Nsa[(s, a)])
+            else:
+                cpuct = self.args.cpuct_mult * math.log(
+                    (1 + self.Ns[s] + self.args.cpuct_base) / self.args.cpuct_base) + self.args.cpuct
+                u = cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s] + EPS)  # Q = 0 ?
+
+            if u > cur_best:
+                cur_best = u
+                best_act = a
 
         a = best_act
         next_s, next_player = self.game.getNextState(canonicalBoard, 1, a)
         next_s = self.game.getCanonicalForm(next_s, next_player)
 
-        v = self.search(next_s)
+        v = self.search(next_s, root=False)
+        if s not in self.Ns:
+            # evicted by a search deeper than max_nodes
+            return -v
+        self.Cs[s].add(self.game.stringRepresentation(next_s))
 
         if (s, a) in self.Qsa:
             self.Qsa[(s, a)] = (self.Nsa[(s, a)] * self.Qsa[(s, a)] + v) / (self.Nsa[(s, a)] + 1)
@@ -0,0 +1,70 @@
+import logging
+
+import numpy as np
+
+from quoridor.QuoridorLogic import QuoridorUtils
+
+log = logging.getLogger(__name__)
+
+
+class MCTS:
+    """
+    This class handles the MCTS tree with the native QuoridorMCTS engine of
+    QuoridorUtils. The selection, expansion and backup run in C++ over the
+    QuoridorState of the boards; Python is only called back to evaluate the
+    encodings of batches of leaves with nnet.predict_encoded.
+
+    It follows MCTS.py: same upper confidence bound and cpuct schedule,
+    Dirichlet noise on the priors of every expanded board, reuse_tree and
+    mcts_max_nodes (the tree is cleared when it holds more boards than that).
+    As in MCTSQuoridor.py, once both players have no walls left only the pawn
+    actions getting closest to the goal keep their prior, and mcts_batch_size
+    leaves are evaluated at once using virtual losses, and with endgame_solver
+    the races below the root are solved instead of evaluated. With a batch of
+    1 no virtual loss is applied, as in MCTSQuoridor.search.
+    """
+
+    def __init__(self, game, nnet, args):
+        self.game = game
+        self.nnet = nnet
+        self.args = args
+        self.reuse_tree = self.args.get('reuse_tree', True)  # keep the subtree of the new root between moves
+        self.max_nodes = self.args.get('mcts_max_nodes', 0)  # maximum number of expanded boards, 0 for no limit
+        self.engine = QuoridorUtils.QuoridorMCTS(
+            self.game.getActionSize(), self.args.cpuct, self.args.cpuct_base, self.args.cpuct_mult,
+            self.args.dirichlet_alpha, self.args.eps, self.args.get('mcts_batch_size', 1),
+            self.args.get('virtual_loss', 1), self.args.get('endgame_solver', True), np.random.randint(2 ** 63))
+        self.masked = 0  # expansions where all valid moves were masked, already reported
+
+    def getActionProb(self, canonicalBoard, temp=1):
+        """
+        This function performs numMCTSSims simulations of MCTS starting from
+        canonicalBoard.
+
+        Returns:
+            probs: a policy vector where the probability of the ith action is
+                   proportional to Nsa[(s,a)]**(1./temp)
+        """
+        if self.reuse_tree:
+            self.engine.prune(canonicalBoard.state)
+        if self.max_nodes and len(self.engine) > self.max_nodes:
+            self.engine.clear()
+
+        counts = self.engine.search(canonicalBoard.state, self.args.numMCTSSims, self.nnet.predict_encoded).tolist()
+        if self.engine.masked > self.masked:
+            # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
+            # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.
+            log.error("All valid moves were masked, doing a workaround.")
+            self.masked = self.engine.masked
+
+        if temp == 0:
+            bestAs = np.array(np.argwhere(counts == np.max(counts))).flatten()
+            bestA = np.random.choice(bestAs)
+            probs = [0] * len(counts)
+            probs[bestA] = 1
+            return probs
+        counts = [x ** (1. / temp) for x in counts]
+        counts_sum = float(sum(counts))
+        probs = [x / counts_sum for x in counts]
+
+        return probs
@@ -11,19 +11,43 @@ log = logging.getLogger(__name__)
 class MCTS:
     """
     This class handles the MCTS tree.
+
+    Every expanded board gets a row in a node table, and the statistics of its
+    edges live in numpy arrays of shape (capacity, action size) indexed by that
+    row. The table doubles its capacity when it is full.
+
+    With reuse_tree set (the default), the board given to getActionProb becomes
+    the root of the tree: the rows that can't be reached from it any more are
+    dropped, and the simulations already spent on its subtree are kept.
+
+    With endgame_solver set (the default), the boards below the root where
+    both players are out of walls are terminal: the pawn race left is solved
+    exactly instead of being evaluated by the network.
     """
 
     def __init__(self, game, nnet, args):
         self.game = game
         self.nnet = nnet
         self.args = args
-        self.Qsa = {}  # stores Q values for s,a (as defined in the paper)
-        self.Nsa = {}  # stores #times edge s,a was visited
-        self.Ns = {}  # stores #times board s was visited
-        self.Ps = {}  # stores initial policy (returned by neural net)
+        self.action_size = self.game.getActionSize()
 
+        self.nodes = {}  # stores the row of the node table for board s
         self.Es = {}  # stores game.getGameEnded ended for board s
-        self.Vs = {}  # stores game.getValidMoves for board s
+        self.Rs = {}  # stores the outcome of the pawn race for board s, once both players are out of walls
+
+        self.capacity = self.args.get('mcts_capacity', 1024)  # initial number of rows of the node table
+        self.Qsa = np.zeros((self.capacity, self.action_size))  # stores Q values for row,a (as defined in the paper)
+        self.Nsa = np.zeros((self.capacity, self.action_size), np.int32)  # stores #times edge row,a was visited
+        self.Ns = np.zeros(self.capacity, np.int64)  # stores #times board row was visited
+        self.Ps = np.zeros((self.capacity, self.action_size))  # stores initial policy (returned by neural net)
+        self.Vs = np.zeros((self.capacity, self.action_size), bool)  # stores game.getValidMoves for board row
+        self.Cs = np.zeros((self.capacity, self.action_size), np.int32)  # stores the row of the board reached by row,a
+
+        self.batch_size = self.args.get('mcts_batch_size', 1)  # leaves evaluated per nnet call
+        self.virtual_loss = self.args.get('virtual_loss', 1)  # pending visits counted as losses
+        self.cpuct_table = []  # stores cpuct for a board visited ns times
+        self.reuse_tree = self.args.get('reuse_tree', True)  # keep the subtree of the new root between moves
+        self.endgame_solver = self.args.get('endgame_solver', True)  # solve the races instead of evaluating them
 
     def getActionProb(self, canonicalBoard, temp=1):
         """
@@ -34,11 +58,21 @@ class MCTS:
             probs: a policy vector where the probability of the ith action is
                    proportional to Nsa[(s,a)]**(1./temp)
         """
-        for i in range(self.args.numMCTSSims):
-            self.search(canonicalBoard)
+        if self.reuse_tree:
+            self.pruneTree(canonicalBoard)
+
+        if self.batch_size > 1:
+            for i in range(0, self.args.numMCTSSims, self.batch_size):
+                self.searchBatch(canonicalBoard, min(self.batch_size, self.args.numMCTSSims - i))
+        else:
+            for i in range(self.args.numMCTSSims):
+                self.search(canonicalBoard)
 
         s = self.game.stringRepresentation(canonicalBoard)
-        counts = [self.Nsa[(s, a)] if (s, a) in self.Nsa else 0 for a in range(self.game.getActionSize())]
+        if s in self.nodes:
+            counts = self.Nsa[self.nodes[s]].tolist()
+        else:
+            counts = [0] * self.action_size
 
         if temp == 0:
             bestAs = np.array(np.argwhere(counts == np.max(counts))).flatten()
@@ -52,7 +86,7 @@ class MCTS:
 
         return probs
 
-    def search(self, canonicalBoard):
+    def search(self, canonicalBoard, root=True):
         """
         This function performs one iteration of MCTS. It is recursively called
         till a leaf node is found. The action chosen at each node is one that
@@ -74,75 +108,270 @@ class MCTS:
 
         s = self.game.stringRepresentation(canonicalBoard)
 
-        if s not in self.Es:
-            self.Es[s] = self.game.getGameEnded(canonicalBoard, 1)
-        if self.Es[s] != 0:
+        e = self.terminalValue(s, canonicalBoard, root)
+        if e != 0:
             # terminal node
-            return -self.Es[s]
+            return -e
 
-        if s not in self.Ps:
+        if s not in self.nodes:
             p, v = self.nnet.predict(canonicalBoard)
-            valids = self.game.getValidActions(canonicalBoard, 1)
-
-            if canonicalBoard.red_walls == 0 and canonicalBoard.blue_walls == 0:
-                ac = canonicalBoard.shortestPathActions()
-                greedy_actions = np.argwhere(ac == np.amax(ac))
-                actions = self.game.getActionSize() * [0]
-                for g in greedy_actions:
-                    actions[g[0]] = 1
+            self.expand(s, canonicalBoard, p)
+            return -float(np.squeeze(v))
 
-                self.Ps[s] = actions * p
-            else:
-                self.Ps[s] = p * valids  # masking invalid moves
-
-            sum_Ps_s = np.sum(self.Ps[s])
-            if sum_Ps_s > 0:
-                self.Ps[s] /= sum_Ps_s  # renormalize
-            else:
-                # if all valid moves were masked make all valid moves equally probable
-
-                # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
-                # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.
-                log.error("All valid moves were masked, doing a workaround.")
-                self.Ps[s] = self.Ps[s] + valids
-                self.Ps[s] /= np.sum(self.Ps[s])
-
-            self.Vs[s] = valids
-            self.Ns[s] = 0
-            return -v
-
-        valids = self.Vs[s]
-        cur_best = -float('inf')
-        best_act = -1
-        # pick the action with the highest upper confidence bound
-        for a in range(self.game.getActionSize()):
-            if valids[a]:
-                if (s, a) in self.Qsa:
-                    cpuct = self.args.cpuct_mult * math.log(
-                        (1 + self.Ns[s] + self.args.cpuct_base) / self.args.cpuct_base) + self.args.cpuct
-                    u = self.Qsa[(s, a)] + cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s]) / (1 + self.Nsa[(s, a)])
-                else:
-                    cpuct = self.args.cpuct_mult * math.log(
-                        (1 + self.Ns[s] + self.args.cpuct_base) / self.args.cpuct_base) + self.args.cpuct
-                    u = cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s] + EPS)  # Q = 0 ?
-
-                if u > cur_best:
-                    cur_best = u
-                    best_act = a
-
-        a = best_act
+        row = self.nodes[s]
+        a = self.selectAction(row)
         next_s, next_player = self.game.getNextState(canonicalBoard, 1, a)
         next_s = self.game.getCanonicalForm(next_s, next_player)
 
-        v = self.search(next_s)
-
-        if (s, a) in self.Qsa:
-            self.Qsa[(s, a)] = (self.Nsa[(s, a)] * self.Qsa[(s, a)] + v) / (self.Nsa[(s, a)] + 1)
-            self.Nsa[(s, a)] += 1
+        v = self.search(next_s, root=False)
+        self.Cs[row, a] = self.nodes.get(self.game.stringRepresentation(next_s), -1)
 
+        n = self.Nsa[row, a]
+        if n > 0:
+            self.Qsa[row, a] = (n * self.Qsa[row, a] + v) / (n + 1)
         else:
-            self.Qsa[(s, a)] = v
-            self.Nsa[(s, a)] = 1
+            self.Qsa[row, a] = v
+        self.Nsa[row, a] = n + 1
 
-        self.Ns[s] += 1
+        self.Ns[row] += 1
         return -v
+
+    def searchBatch(self, canonicalBoard, batch_size):
+        """
+        This function performs batch_size iterations of MCTS starting from
+        canonicalBoard, evaluating all the leaves found with a single call to
+        nnet.predict_batch.
+
+        Each descent applies a virtual loss to the edges it walks through, so
+        the following descents of the same batch are steered towards other
+        leaves. Once the batch is evaluated the virtual losses are reverted and
+        the real values are backed up. A descent that reaches a leaf already
+        waiting for evaluation in this batch is discarded.
+        """
+        leaves = []
+        pending = set()
+
+        for _ in range(batch_size):
+            board = canonicalBoard
+            path = []
+            while True:
+                s = self.game.stringRepresentation(board)
+
+                e = self.terminalValue(s, board, not path)
+                if e != 0:
+                    # terminal node
+                    self.backup(path, -e)
+                    break
+
+                if s not in self.nodes:
+                    # leaf node
+                    if s in pending:
+                        self.revertVirtualLoss(path)
+                    else:
+                        pending.add(s)
+                        leaves.append((s, board, path))
+                    break
+
+                row = self.nodes[s]
+                if path:
+                    self.Cs[path[-1]] = row
+                a = self.selectAction(row)
+                self.addVirtualLoss(row, a)
+                path.append((row, a))
+
+                next_s, next_player = self.game.getNextState(board, 1, a)
+                board = self.game.getCanonicalForm(next_s, next_player)
+
+        if not leaves:
+            return
+
+        try:
+            pis, vs = self.nnet.predict_batch([board for _, board, _ in leaves])
+        except BaseException:
+            # the tree may be reused for the next move, so it must not keep the virtual losses
+            for _, _, path in leaves:
+                self.revertVirtualLoss(path)
+            raise
+        for (s, board, path), p, v in zip(leaves, pis, vs):
+            self.expand(s, board, p)
+            if path:
+                self.Cs[path[-1]] = self.nodes[s]
+            self.backup(path, -float(v))
+
+    def terminalValue(self, s, canonicalBoard, root):
+        """
+        Returns game.getGameEnded(canonicalBoard, 1). With endgame_solver, when
+        both players are out of walls and canonicalBoard is not the root, which
+        still needs visits to choose a move, returns the outcome of the race
+        left instead.
+        """
+        if s not in self.Es:
+            self.Es[s] = self.game.getGameEnded(canonicalBoard, 1)
+        if self.Es[s] != 0 or root or not self.endgame_solver:
+            return self.Es[s]
+        if s not in self.Rs:
+            self.Rs[s] = canonicalBoard.getRaceResult()
+        return self.Rs[s]
+
+    def expand(self, s, canonicalBoard, p):
+        """
+        Adds the leaf s to the node table, storing the masked and renormalized
+        policy p returned by the neural network.
+        """
+        valids = self.game.getValidActions(canonicalBoard, 1)
+
+        if canonicalBoard.red_walls == 0 and canonicalBoard.blue_walls == 0:
+            ac = canonicalBoard.shortestPathActions()
+            greedy_actions = np.argwhere(ac == np.amax(ac))
+            actions = self.action_size * [0]
+            for g in greedy_actions:
+                actions[g[0]] = 1
+
+            ps = actions * p
+        else:
+            ps = p * valids  # masking invalid moves
+
+        sum_Ps_s = np.sum(ps)
+        if sum_Ps_s > 0:
+            ps /= sum_Ps_s  # renormalize
+        else:
+            # if all valid moves were masked make all valid moves equally probable
+
+            # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
+            # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.
+            log.error("All valid moves were masked, doing a workaround.")
+            ps = ps + valids
+            ps /= np.sum(ps)
+
+        row = len(self.nodes)
+        if row == self.capacity:
+            self.grow()
+        self.nodes[s] = row
+
+        self.Ps[row] = ps
+        self.Vs[row] = valids
+        self.Qsa[row] = 0
+        self.Nsa[row] = 0
+        self.Ns[row] = 0
+        self.Cs[row] = -1
+
+    def grow(self):
+        """
+        Doubles the capacity of the node table.
+        """
+        self.capacity *= 2
+        for name in ('Qsa', 'Nsa', 'Ns', 'Ps', 'Vs', 'Cs'):
+            old = getattr(self, name)
+            new = np.zeros((self.capacity,) + old.shape[1:], old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def pruneTree(self, canonicalBoard):
+        """
+        Makes canonicalBoard the root of the tree. The rows of the boards that
+        can't be reached from it are dropped and the remaining ones are moved to
+        the front of the table, keeping their statistics.
+        """
+        size = len(self.nodes)
+        root = self.nodes.get(self.game.stringRepresentation(canonicalBoard))
+        if root is None:
+            self.nodes = {}
+            self.Es = {}
+            self.Rs = {}
+            return
+
+        reachable = np.zeros(size, bool)
+        reachable[root] = True
+        frontier = np.array([root])
+        while len(frontier):
+            children = self.Cs[frontier]
+            children = np.unique(children[children >= 0])
+            frontier = children[~reachable[children]]
+            reachable[frontier] = True
+
+        keep = np.flatnonzero(reachable)
+        if len(keep) == size:
+            return
+        remap = np.full(size + 1, -1, np.int32)  # the last entry maps the missing children (-1) to -1
+        remap[keep] = np.arange(len(keep))
+        for name in ('Qsa', 'Nsa', 'Ns', 'Ps', 'Vs'):
+            table = getattr(self, name)
+            table[:len(keep)] = table[keep]
+        self.Cs[:len(keep)] = remap[self.Cs[keep]]
+
+        self.nodes = {s: int(remap[row]) for s, row in self.nodes.items() if reachable[row]}
+        self.Es = {s: e for s, e in self.Es.items() if s in self.nodes}
+        self.Rs = {}  # only boards below the root, which are never expanded
+
+    def cpuctSchedule(self, ns):
+        """
+        Returns cpuct for a board visited ns times, computing the log once per
+        value of ns.
+        """
+        while len(self.cpuct_table) <= ns:
+            self.cpuct_table.append(self.args.cpuct_mult * math.log(
+                (1 + len(self.cpuct_table) + self.args.cpuct_base) / self.args.cpuct_base) + self.args.cpuct)
+        return self.cpuct_table[ns]
+
+    def selectAction(self, row):
+        """
+        Returns the valid action of the board in row with the highest upper
+        confidence bound, computed for all the actions at once.
+        """
+        ns = int(self.Ns[row])
+        if ns == 0:
+            # no edge visited yet, the bound is proportional to the prior,
+            # which is zero for invalid actions
+            return int(np.argmax(self.Ps[row]))
+
+        nsa = self.Nsa[row]
+        cp = self.Ps[row] * self.cpuctSchedule(ns)
+        u = cp * math.sqrt(ns)
+        u /= nsa + 1
+        u += self.Qsa[row]
+        np.multiply(cp, math.sqrt(ns + EPS), out=u, where=nsa == 0)  # Q = 0 ?
+        u[~self.Vs[row]] = -np.inf
+        return int(np.argmax(u))
+
+    def addVirtualLoss(self, row, a):
+        """
+        Counts virtual_loss pending visits of the edge row,a as losses.
+        """
+        vl = self.virtual_loss
+        n = self.Nsa[row, a]
+        if n > 0:
+            self.Qsa[row, a] = (n * self.Qsa[row, a] - vl) / (n + vl)
+        else:
+            self.Qsa[row, a] = -1.
+        self.Nsa[row, a] = n + vl
+        self.Ns[row] += vl
+
+    def revertVirtualLoss(self, path):
+        """
+        Removes the virtual losses added along path without backing up a value.
+        """
+        vl = self.virtual_loss
+        for row, a in reversed(path):
+            n = self.Nsa[row, a] - vl
+            if n > 0:
+                self.Qsa[row, a] = (self.Nsa[row, a] * self.Qsa[row, a] + vl) / n
+            else:
+                self.Qsa[row, a] = 0
+            self.Nsa[row, a] = n
+            self.Ns[row] -= vl
+
+    def backup(self, path, v):
+        """
+        Removes the virtual losses added along path and propagates v up the
+        path, where v is the value of the last edge for the player who took it.
+        """
+        vl = self.virtual_loss
+        for row, a in reversed(path):
+            n = self.Nsa[row, a] - vl
+            if n > 0:
+                self.Qsa[row, a] = (self.Nsa[row, a] * self.Qsa[row, a] + vl + v) / (n + 1)
+            else:
+                self.Qsa[row, a] = v
+            self.Nsa[row, a] = n + 1
+            self.Ns[row] += 1 - vl
+            v = -v
@@ -21,6 +21,8 @@ class NeuralNet():
                       (board, pi, v). pi is the MCTS informed policy vector for
                       the given board, and v is its value. The examples has
                       board in its canonical form.
+                      It may also be a TrainingData holding the examples as
+                      columns, such as ReplayBuffer.trainingData returns.
         """
         pass
 
@@ -36,6 +38,31 @@ class NeuralNet():
         """
         pass
 
+    def predict_batch(self, boards):
+        """
+        Input:
+            boards: a list of boards in their canonical form.
+
+        Returns:
+            pis: a numpy array of shape (len(boards), game.getActionSize) with
+                 the policy vector of each board
+            vs: a numpy array of length len(boards) with the value of each
+                board
+        """
+        pass
+
+    def predict_encoded(self, boards, walls, values):
+        """
+        Input:
+            boards, walls, values: numpy arrays stacking the encodings
+                                   returned by board.getBoard() of a batch
+                                   of canonical boards.
+
+        Returns:
+            pis, vs: as predict_batch
+        """
+        pass
+
     def save_checkpoint(self, folder, filename):
         """
         Saves the current neural network (with its parameters) in
@@ -0,0 +1,212 @@
+import bisect
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from alphazero_general.TrainingData import Chunk, TrainingData, compactLayout, encodeColumns, exampleColumns, \
+    storedArrays
+
+log = logging.getLogger(__name__)
+
+
+class ReplayBuffer:
+    """
+    The training examples (board, pi, v) of the latest self-play iterations,
+    kept on disk as fixed-dtype columns: input0, input1, ... for the arrays of
+    the board encoding (boards, walls and values for Quoridor), pi and v.
+    They are stored compactly (see TrainingData.compactLayout): the 0/1
+    planes bit-packed, the float features in float16 and pi sparse.
+
+    Every iteration gets its own chunk, a folder with one raw file per stored
+    array and a meta.json holding the number of rows and the layout of the
+    columns. Examples are appended to the files as they arrive, and dropping
+    an iteration deletes its chunk, so nothing is ever rewritten.
+
+    With resume, the buffer goes on with the chunks already in folder.
+    Otherwise it starts empty, and the folder of an earlier run is moved aside
+    to folder.1, folder.2, ... rather than deleted.
+    """
+
+    def __init__(self, folder, max_chunks, max_rows=None, resume=False):
+        self.folder = folder
+        self.max_chunks = max_chunks  # number of iterations kept
+        self.max_rows = max_rows  # number of rows kept per iteration, the latest ones
+        if not resume and os.path.isdir(folder) and os.listdir(folder):
+            k = 1
+            while os.path.exists(f'{folder}.{k}'):
+                k += 1
+            log.warning(f'Moving the replay buffer of an earlier run to "{folder}.{k}"')
+            os.rename(folder, f'{folder}.{k}')
+        os.makedirs(folder, exist_ok=True)
+        # ids of the chunks, oldest first, skipping the ones left unfinished
+        self.chunks = sorted(int(name) for name in os.listdir(folder)
+                             if name.isdigit() and os.path.isfile(self.metaFile(int(name))))
+        self.current = None  # id of the chunk being written
+        self.metas = {}
+
+    def chunkFolder(self, chunk):
+        return os.path.join(self.folder, '%06d' % chunk)
+
+    def metaFile(self, chunk):
+        return os.path.join(self.chunkFolder(chunk), 'meta.json')
+
+    def columnFile(self, chunk, name):
+        return os.path.join(self.chunkFolder(chunk), name + '.bin')
+
+    def meta(self, chunk):
+        if chunk not in self.metas:
+            with open(self.metaFile(chunk)) as f:
+                self.metas[chunk] = json.load(f)
+        return self.metas[chunk]
+
+    def writeMeta(self, chunk, meta):
+        # replaced atomically, so the rows it counts are always fully written
+        path = self.metaFile(chunk)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+        self.metas[chunk] = meta
+
+    def startChunk(self):
+        """
+        Starts the chunk of a new iteration, which receives the following
+        append() calls.
+        """
+        self.finishChunk()
+        self.current = max(self.chunks + [0]) + 1
+        self.createChunk(self.current)
+
+    def createChunk(self, chunk):
+        os.makedirs(self.chunkFolder(chunk))
+        self.writeMeta(chunk, {'rows': 0, 'start': 0, 'columns': None, 'nnz': {}})
+        bisect.insort(self.chunks, chunk)
+
+    def append(self, examples):
+        """
+        Appends a list of examples (board, pi, v) to the current chunk, where
+        board is an array or a tuple of arrays, such as Game.getSymmetries
+        returns.
+        """
+        if not examples:
+            return
+        meta = dict(self.meta(self.current))
+        if meta['columns'] is None:
+            meta['columns'] = compactLayout(examples[0])
+            meta['nnz'] = {name: 0 for name, spec in meta['columns'].items() if spec['codec'] == 'sparse'}
+        arrays = encodeColumns(meta['columns'], exampleColumns(examples), meta['nnz'])
+        for name, array in arrays.items():
+            with open(self.columnFile(self.current, name), 'ab') as f:
+                f.write(np.ascontiguousarray(array).tobytes())
+        meta['rows'] += len(examples)
+        meta['nnz'] = {name: int(arrays[name + '.offset'][-1]) for name in meta['nnz']}
+        self.writeMeta(self.current, meta)
+
+    def finishChunk(self):
+        """
+        Closes the current chunk, keeping only its max_rows latest rows, and
+        deletes the oldest chunks beyond max_chunks.
+        """
+        if self.current is None:
+            return
+        meta = dict(self.meta(self.current))
+        if self.max_rows is not None and meta['rows'] - meta['start'] > self.max_rows:
+            meta['start'] = meta['rows'] - self.max_rows
+            self.writeMeta(self.current, meta)
+        self.current = None
+
+        while len(self.chunks) > self.max_chunks:
+            log.warning(f"Removing the oldest iteration of the replay buffer. iterations = {len(self.chunks)}")
+            self.dropChunk(self.chunks[0])
+
+    def dropChunk(self, chunk):
+        shutil.rmtree(self.chunkFolder(chunk))
+        self.chunks.remove(chunk)
+        self.metas.pop(chunk, None)
+
+    def rows(self, chunk):
+        meta = self.meta(chunk)
+        return meta['rows'] - meta['start']
+
+    def __len__(self):
+        return sum(self.rows(chunk) for chunk in self.chunks)
+
+    def chunk(self, chunk):
+        """
+        Returns a Chunk of the arrays of a chunk, memory-mapped read-only from
+        its files, or None if it has no rows.
+        """
+        meta = self.meta(chunk)
+        if meta['columns'] is None:
+            return None
+        # chunks written before the compact layout hold float32 columns
+        layout = {name: dict(spec, codec=spec.get('codec', 'float32')) for name, spec in meta['columns'].items()}
+        # plain ndarray views, faster to index than np.memmap
+        arrays = {name: np.asarray(np.memmap(self.columnFile(chunk, name), dtype, 'r', shape=shape))
+                  for name, (dtype, shape) in storedArrays(layout, meta['rows'], meta.get('nnz', {})).items()}
+        return Chunk(layout, arrays, meta['start'], meta['rows'])
+
+    def examples(self):
+        """
+        Returns the examples of all the chunks as a list of (board, pi, v),
+        board being the tuple of the float32 input columns, or the single one.
+        """
+        examples = []
+        for chunk in filter(None, map(self.chunk, self.chunks)):
+            columns = chunk.decode()
+            inputs = [columns['input%d' % k] for k in range(len(columns) - 2)]
+            boards = zip(*inputs) if len(inputs) > 1 else inputs[0]
+            examples.extend(zip(boards, columns['pi'], columns['v'].tolist()))
+        return examples
+
+    def trainingData(self):
+        """
+        Returns the TrainingData of the examples of all the chunks.
+        """
+        return TrainingData(list(filter(None, map(self.chunk, self.chunks))))
+
+    def insertChunks(self, count):
+        """
+        Renumbers the chunks to make room for count chunks older than all of
+        them, returning the first of their ids.
+        """
+        first = self.chunks[0] if self.chunks else 1
+        for chunk in reversed(self.chunks):
+            os.rename(self.chunkFolder(chunk), self.chunkFolder(chunk + count))
+        self.chunks = [chunk + count for chunk in self.chunks]
+        self.metas = {chunk + count: meta for chunk, meta in self.metas.items()}
+        return first
+
+    def importChunks(self, folder):
+        """
+        Copies the finished chunks of the replay buffer in folder before the
+        ones of this buffer, as older iterations, as many as max_chunks leaves
+        room for.
+        """
+        self.finishChunk()
+        other = ReplayBuffer(folder, self.max_chunks, resume=True)
+        chunks = other.chunks[max(0, len(other.chunks) - (self.max_chunks - len(self.chunks))):]
+        first = self.insertChunks(len(chunks))
+        for i, chunk in enumerate(chunks):
+            self.current = first + i
+            shutil.copytree(other.chunkFolder(chunk), self.chunkFolder(self.current))
+            bisect.insort(self.chunks, self.current)
+            self.finishChunk()
+
+    def importHistory(self, history):
+        """
+        Adds the iterations of a trainExamplesHistory list, the format of the
+        .examples files written by older versions, one chunk per iteration,
+        before the ones of this buffer as importChunks does.
+        """
+        self.finishChunk()
+        history = list(history)
+        history = history[max(0, len(history) - (self.max_chunks - len(self.chunks))):]
+        first = self.insertChunks(len(history))
+        for i, examples in enumerate(history):
+            self.current = first + i
+            self.createChunk(self.current)
+            self.append(list(examples))
+            self.finishChunk()
@@ -0,0 +1,200 @@
+import logging
+import multiprocessing as mp
+import os
+import queue
+import shutil
+
+import numpy as np
+
+from alphazero_general.InferenceServer import InferenceServer
+from alphazero_general.MCTS import newMCTS
+
+log = logging.getLogger(__name__)
+
+
+def executeEpisode(game, mcts, args):
+    """
+    This function executes one episode of self-play, starting with player 1.
+    As the game is played, each turn is added as a training example to
+    trainExamples. The game is played till the game ends. After the game
+    ends, the outcome of the game is used to assign values to each example
+    in trainExamples.
+
+    It uses a temp=1 if episodeStep < tempThreshold, and thereafter
+    uses temp=0.
+
+    Returns:
+        trainExamples: a list of examples of the form (canonicalBoard, currPlayer, pi,v)
+                       pi is the MCTS informed policy vector, v is +1 if
+                       the player eventually won the game, else -1.
+    """
+    trainExamples = []
+    board = game.getInitBoard()
+    curPlayer = 1
+    episodeStep = 0
+
+    while True:
+        episodeStep += 1
+        canonicalBoard = game.getCanonicalForm(board, curPlayer)
+        temp = int(episodeStep < args.tempThreshold)
+
+        pi = mcts.getActionProb(canonicalBoard, temp=temp)
+        sym = game.getSymmetries(canonicalBoard, pi)
+        for b, p in sym:
+            trainExamples.append([b, curPlayer, p, None])
+
+        action = np.random.choice(len(pi), p=pi)
+        board, curPlayer = game.getNextState(board, curPlayer, action)
+
+        r = game.getGameEnded(board, curPlayer)
+
+        if r != 0:
+            return [(x[0], x[2], r * ((-1) ** (x[1] != curPlayer))) for x in trainExamples]
+
+
+def selfPlayWorker(game, nnet_class, nn_args, args, folder, filename, client, tasks, results):
+    """
+    Main loop of a self-play process. Every task is the weights version the
+    episode must be played with; the weights are reloaded from folder/filename
+    only when that version changes. None stops the worker.
+
+    If client is given, the network is evaluated by the inference server
+    through it instead of by a local copy.
+    """
+    import torch
+    torch.set_num_threads(1)
+    np.random.seed()
+
+    nnet = client if client is not None else nnet_class(game, nn_args)
+    version = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if task != version and client is None:
+            nnet.load_checkpoint(folder=folder, filename=filename)
+        version = task
+        mcts = newMCTS(game, nnet, args)  # reset search tree
+        results.put(executeEpisode(game, mcts, args))
+
+
+class SelfPlayWorkers:
+    """
+    A pool of numSelfPlayWorkers processes playing self-play episodes. Each
+    process owns its game, network copy and MCTS, and streams the examples of
+    every finished episode back to the trainer.
+
+    With inferenceServer set, the processes share a single network held by an
+    InferenceServer instead of owning a copy each.
+    """
+
+    def __init__(self, game, nnet, args):
+        self.game = game
+        self.nnet = nnet
+        self.args = args
+        self.folder = args.checkpoint
+        self.filename = 'selfplay.pth.tar'
+        self.version = None  # weights version last saved for the workers
+
+        if args.get('inferenceServer', False):
+            self.server = InferenceServer(game, nnet, args, args.numSelfPlayWorkers)
+            clients = [self.server.client(i) for i in range(args.numSelfPlayWorkers)]
+        else:
+            self.server = None
+            clients = [None] * args.numSelfPlayWorkers
+
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = [ctx.Process(target=selfPlayWorker,
+                                    args=(game, nnet.__class__, nnet.nn_args, args, self.folder, self.filename,
+                                          client, self.tasks, self.results),
+                                    daemon=True)
+                        for client in clients]
+        for w in self.workers:
+            w.start()
+
+    def useWeights(self, version, checkpoint=None):
+        """
+        Makes the following episodes use the weights of the (folder, filename)
+        checkpoint, or the current ones of nnet, if version differs from the
+        last one sent.
+        """
+        if version == self.version:
+            return
+        if checkpoint is None:
+            self.nnet.save_checkpoint(folder=self.folder, filename=self.filename)
+        else:
+            # replaced atomically, workers may still be loading the previous file
+            path = os.path.join(self.folder, self.filename)
+            shutil.copyfile(os.path.join(*checkpoint), path + '.tmp')
+            os.replace(path + '.tmp', path)
+        if self.server is not None:
+            self.server.loadWeights(self.folder, self.filename)
+        self.version = version
+
+    def playEpisodes(self, numEps, version):
+        """
+        Plays numEps episodes with the current weights of nnet, saving them for
+        the workers first if version differs from the last one sent.
+
+        Yields the examples of each episode as soon as it finishes.
+        """
+        self.useWeights(version)
+
+        for _ in range(numEps):
+            self.tasks.put(version)
+        for _ in range(numEps):
+            yield self.getResult()
+
+        if self.server is not None:
+            stats = self.server.stats()
+            log.info(f"Inference server: {stats['batches']} batches, mean size {stats['mean_batch_size']:.1f} "
+                     f"(fill {stats['batch_fill']:.0%}), mean queue latency {stats['mean_latency_ms']:.2f} ms")
+
+    def playContinuously(self, weights):
+        """
+        Yields the examples of episodes for as long as it is iterated, keeping
+        a task queued for every worker. weights() returns the version and the
+        (folder, filename) checkpoint of the weights the next episodes are
+        played with, see useWeights.
+
+        Closing the generator waits for the episodes already started and
+        drops their examples.
+        """
+        started = 0
+        try:
+            while True:
+                version, checkpoint = weights()
+                self.useWeights(version, checkpoint)
+                for _ in range(len(self.workers) - started):
+                    self.tasks.put(version)
+                started = len(self.workers)
+                result = self.getResult()
+                started -= 1
+                yield result
+        finally:
+            for _ in range(started):
+                self.getResult()
+
+    def getResult(self):
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                if not all(w.is_alive() for w in self.workers):
+                    raise RuntimeError('A self-play worker died unexpectedly')
+                if self.server is not None and not self.server.isAlive():
+                    raise RuntimeError('The inference server died unexpectedly')
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        if self.server is not None and not self.server.isAlive():
+            # the workers may be stuck waiting for it
+            for w in self.workers:
+                w.terminate()
+        for w in self.workers:
+            w.join()
+        if self.server is not None:
+            self.server.close()
@@ -0,0 +1,231 @@
+import queue
+import threading
+
+import numpy as np
+
+
+# Storage formats of the columns, all decoded to float32 arrays:
+#   float32, float16: the values as they are or in half precision
+#   bits: 0/1 values packed 8 per byte along every row
+#   sparse: the nonzero entries of the rows, as uint16 indices (.index) and
+#           float16 values (.value), and the end of every row in them (.offset)
+
+
+def exampleColumns(examples):
+    """
+    Returns a list of examples (board, pi, v) as a dict of float32 columns:
+    input0, input1, ... for the arrays of the boards, which are arrays or
+    tuples of arrays, pi and v.
+    """
+    boards, pis, vs = zip(*examples)
+    boards = [b if isinstance(b, tuple) else (b,) for b in boards]
+    columns = {'input%d' % k: np.array(inputs, np.float32) for k, inputs in enumerate(zip(*boards))}
+    columns['pi'] = np.array(pis, np.float32)
+    columns['v'] = np.array(vs, np.float32)
+    return columns
+
+
+def compactLayout(example):
+    """
+    Returns the storage of the columns of examples like example: the integer
+    arrays of the board, 0/1 planes, as bits and its float arrays as float16,
+    pi sparse and v as float32.
+    """
+    board, pi, v = example
+    board = board if isinstance(board, tuple) else (board,)
+    layout = {}
+    for k, x in enumerate(board):
+        x = np.asarray(x)
+        codec = 'bits' if x.dtype == bool or np.issubdtype(x.dtype, np.integer) else 'float16'
+        layout['input%d' % k] = {'codec': codec, 'shape': list(x.shape)}
+    layout['pi'] = {'codec': 'sparse', 'shape': [len(pi)]}
+    layout['v'] = {'codec': 'float32', 'shape': []}
+    return layout
+
+
+def storedArrays(layout, rows, nnz):
+    """
+    Returns the dtype and shape of every array storing rows rows of the
+    columns of layout, nnz giving the number of entries of the sparse columns.
+    """
+    arrays = {}
+    for name, spec in layout.items():
+        shape = tuple(spec['shape'])
+        if spec['codec'] == 'bits':
+            arrays[name] = (np.uint8, (rows, (int(np.prod(shape)) + 7) // 8))
+        elif spec['codec'] == 'sparse':
+            arrays[name + '.index'] = (np.uint16, (nnz[name],))
+            arrays[name + '.value'] = (np.float16, (nnz[name],))
+            arrays[name + '.offset'] = (np.int64, (rows,))
+        else:
+            arrays[name] = (np.dtype(spec['codec']), (rows,) + shape)
+    return arrays
+
+
+def encodeColumns(layout, columns, nnz):
+    """
+    Returns the float32 columns in the storage of layout, as a dict of the
+    arrays listed by storedArrays. The offsets of the sparse columns start at
+    nnz, their number of entries already stored.
+    """
+    arrays = {}
+    for name, spec in layout.items():
+        x = columns[name].reshape(len(columns[name]), -1)
+        if spec['codec'] == 'bits':
+            if ((x != 0) & (x != 1)).any():
+                raise ValueError(f'{name} has values other than 0 and 1')
+            arrays[name] = np.packbits(x != 0, axis=1)
+        elif spec['codec'] == 'sparse':
+            rows, index = np.nonzero(x)
+            arrays[name + '.index'] = index.astype(np.uint16)
+            arrays[name + '.value'] = x[rows, index].astype(np.float16)
+            arrays[name + '.offset'] = nnz[name] + np.cumsum(np.count_nonzero(x, axis=1))
+        else:
+            arrays[name] = columns[name].astype(spec['codec'])
+    return arrays
+
+
+def decodeRows(layout, arrays, rows):
+    """
+    Returns the rows of the columns of layout stored in arrays, as a dict of
+    float32 arrays. Reads are sequential if rows are sorted.
+    """
+    columns = {}
+    for name, spec in layout.items():
+        shape = tuple(spec['shape'])
+        size = int(np.prod(shape))
+        if spec['codec'] == 'bits':
+            x = np.unpackbits(arrays[name][rows], axis=1, count=size).astype(np.float32)
+        elif spec['codec'] == 'sparse':
+            offsets = arrays[name + '.offset']
+            ends = offsets[rows]
+            starts = np.where(rows > 0, offsets[np.maximum(rows - 1, 0)], 0)
+            lengths = ends - starts
+            # positions of the entries of every row, one after the other
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            x = np.zeros((len(rows), size), np.float32)
+            x[np.repeat(np.arange(len(rows)), lengths), arrays[name + '.index'][positions]] = \
+                arrays[name + '.value'][positions]
+        else:
+            x = np.asarray(arrays[name][rows], np.float32)
+        columns[name] = x.reshape((len(rows),) + shape)
+    return columns
+
+
+class Chunk:
+    """
+    Rows start to rows of columns stored as arrays (maybe memory-mapped) with
+    the layout of compactLayout or storedArrays.
+    """
+
+    def __init__(self, layout, arrays, start, rows):
+        self.layout = layout
+        self.arrays = arrays
+        self.start = start
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows - self.start
+
+    def decode(self, rows=None):
+        """
+        Returns the float32 columns of the given rows, counted from start, or
+        of all of them.
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        return decodeRows(self.layout, self.arrays, rows + self.start)
+
+
+class TrainingData:
+    """
+    The examples a network is trained with, as Chunks of columns, usually
+    memory-mapped from the files of a ReplayBuffer. Minibatches are gathered
+    from them by fancy indexing and decoded a batch at a time, without any
+    work per example in Python.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = [chunk for chunk in chunks if len(chunk)]
+        self.names = list(self.chunks[0].layout) if self.chunks else []
+        self.num_inputs = len(self.names) - 2
+        # first row of every chunk, and the total number of rows
+        self.offsets = np.cumsum([0] + [len(chunk) for chunk in self.chunks])
+
+    @classmethod
+    def fromExamples(cls, examples):
+        """
+        Returns the TrainingData of a list of examples (board, pi, v), kept
+        as float32 columns.
+        """
+        if not len(examples):
+            return cls([])
+        columns = exampleColumns(examples)
+        layout = {name: {'codec': 'float32', 'shape': list(x.shape[1:])} for name, x in columns.items()}
+        return cls([Chunk(layout, columns, 0, len(examples))])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def gather(self, ids):
+        """
+        Returns the inputs tuple, pis and vs of the examples at ids, sorted,
+        as new float32 arrays.
+        """
+        # sorted reads are sequential in the memory-mapped files, and every
+        # chunk fills a slice of the batch
+        ids = np.sort(ids)
+        bounds = np.searchsorted(ids, self.offsets)
+        batch = {}
+        for c, chunk in enumerate(self.chunks):
+            if bounds[c] == bounds[c + 1]:
+                continue
+            columns = chunk.decode(ids[bounds[c]:bounds[c + 1]] - self.offsets[c])
+            for name in self.names:
+                if name not in batch:
+                    batch[name] = np.empty((len(ids),) + columns[name].shape[1:], np.float32)
+                batch[name][bounds[c]:bounds[c + 1]] = columns[name]
+        return tuple(batch[name] for name in self.names[:-2]), batch['pi'], batch['v']
+
+    def batches(self, batch_size, count, transform=None, prefetch=2):
+        """
+        Yields count minibatches of batch_size examples sampled uniformly with
+        replacement, as returned by gather and then transform. The next
+        prefetch minibatches are gathered and transformed on a background
+        thread while the current one is used.
+        """
+        ready = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def offer(item):
+            # gives up once the consumer has stopped
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for _ in range(count):
+                    ids = np.random.randint(len(self), size=batch_size)
+                    batch = self.gather(ids)
+                    if transform is not None:
+                        batch = transform(batch)
+                    if not offer((True, batch)):
+                        return
+            except Exception as e:
+                offer((False, e))
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            for _ in range(count):
+                ok, batch = ready.get()
+                if not ok:
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
@@ -1,4 +1,5 @@
 import logging
+import multiprocessing as mp
 import sys
 import coloredlogs
 
@@ -25,6 +26,17 @@ args = dotdict({
     'cpuct_mult': 2,
     'dirichlet_alpha': 0.3,
     'eps': 0.25,
+    'reuse_tree': True,  # Keep the MCTS subtree of the position reached between moves.
+    'mcts_max_nodes': 100000,  # Maximum number of boards kept by each MCTS, 0 for no limit.
+    'mcts_engine': 'python',  # MCTS of self-play and arena, 'python' or 'native' (C++ search over the board state).
+    'endgame_solver': True,  # Solve the pawn race once both players are out of walls instead of evaluating it.
+    'numSelfPlayWorkers': mp.cpu_count() - 2,  # Number of self-play processes, sequential self-play if <= 1.
+    'inferenceServer': False,  # Share a single network between the self-play processes.
+    'inferenceBatchSize': 64,  # Maximum number of boards per forward pass of the inference server.
+    'inferenceTimeout': 0.005,  # Seconds the inference server waits for a batch to fill.
+    'inferenceThreads': 4,  # Torch threads of the inference server.
+    'pipelined': False,  # Self-play, training and model comparison at the same time, see Coach.learnPipelined.
+    'trainInterval': 800,  # Number of new self-play episodes between two trainings of the pipelined mode.
 
     # 'checkpoint': '/run/media/leleco/4EB5CC9A2FD2A5F9/dev/models/n5_v5/test',
     'checkpoint': '/run/media/leleco/4EB5CC9A2FD2A5F9/dev/models/n5v5/1600x300',
@@ -6,7 +6,7 @@ import numpy as np
 sys.path.append(os.path.join(os.path.dirname(__file__), 'pathfind/build'))
 
 from alphazero_general.Game import Game
-from .QuoridorLogic import QuoridorBoard
+from .QuoridorLogic import QuoridorBoard, PAWN_MIRROR
 
 
 class QuoridorGame(Game):
@@ -49,7 +49,7 @@ class QuoridorGame(Game):
             nextBoard: board after applying action
             nextPlayer: player who plays in the next turn (should be -player)
         """
-        next_board = QuoridorBoard(self.n, board=board)
+        next_board = board.copy()
         next_board.executeAction(player, action)
         return next_board, -player
 
@@ -79,6 +79,13 @@ class QuoridorGame(Game):
         """
         return board.getGameEnded(player)
 
+    def getEndgameResult(self, canonicalBoard):
+        """
+        Returns the outcome of the pawn race once both players are out of
+        walls, solved exactly, and 0 while any walls are left.
+        """
+        return canonicalBoard.getRaceResult()
+
     def getCanonicalForm(self, board, player):
         """
         Input:
@@ -93,7 +100,7 @@ class QuoridorGame(Game):
                             board as is. When the player is black, we can invert
                             the colors and return the board.
         """
-        next_board = QuoridorBoard(self.n, board=board)
+        next_board = board.copy()
         return next_board.makeCanonical(player)
 
     def getSymmetries(self, board, pi):
@@ -106,18 +113,35 @@ class QuoridorGame(Game):
             symmForms: a list of [(board,pi)] where each tuple is a symmetrical
                        form of the board and the corresponding pi vector. This
                        is used when training the neural network from examples.
+                       Only the board itself, the horizontal flip is applied
+                       by getSymmetriesBatch while training.
         """
-        pawn_moves = 12
-        vwa_size = pawn_moves + (self.n - 1) ** 2
-        vw_actions = list(np.flipud(np.array(pi[pawn_moves:vwa_size]).reshape(self.n - 1, self.n - 1)).flatten())
-        hw_actions = list(np.flipud(np.array(pi[vwa_size:]).reshape(self.n - 1, self.n - 1)).flatten())
-        pi2 = pi[:12] + vw_actions + hw_actions
+        return [(board.getBoard(), pi)]
 
-        pi2[2], pi2[3] = pi2[3], pi2[2]
-        pi2[6], pi2[7] = pi2[7], pi2[6]
-        pi2[8], pi2[10] = pi2[10], pi2[8]
-        pi2[9], pi2[11] = pi2[9], pi2[11]
-        return [(board.getBoard(), pi), (board.getBoardFlippedHorizontally(), pi2)]
+    def getSymmetriesBatch(self, inputs, pis):
+        """
+        Input:
+            inputs: (boards, walls, values) stacked encodings of a batch
+            pis: (batch size, action size) policy vectors
+
+        Returns:
+            inputs, pis: the batch with a random half of the examples flipped
+                         horizontally, as getBoardFlippedHorizontally does
+        """
+        boards, walls, values = inputs
+        flip = np.random.rand(len(pis)) < 0.5
+        boards, walls, values, pis = boards.copy(), walls.copy(), values.copy(), pis.copy()
+        boards[flip] = boards[flip, :, ::-1]
+        walls[flip] = walls[flip, :, ::-1]
+        values[flip, :12] = values[flip][:, PAWN_MIRROR]
+
+        w = (self.n - 1) ** 2
+        flipped = pis[flip]
+        pis[flip, :12] = flipped[:, PAWN_MIRROR]
+        for start in (12, 12 + w):
+            actions = flipped[:, start:start + w].reshape(-1, self.n - 1, self.n - 1)
+            pis[flip, start:start + w] = actions[:, ::-1].reshape(-1, w)
+        return (boards, walls, values), pis
 
     def stringRepresentation(self, board):
         """
@@ -125,10 +149,11 @@ class QuoridorGame(Game):
             board: current board
 
         Returns:
-            boardString: a quick conversion of board to a string format.
-                         Required by MCTS for hashing.
+            boardString: the 64-bit Zobrist key of the board, maintained
+                         incrementally by the board. Required by MCTS for
+                         hashing.
         """
-        return board.getBoardHashable()
+        return board.zobrist
 
     def display(self, board, name=None, save_folder=None, save=True):
         board.plot(name=name, save_folder=save_folder, save=save)
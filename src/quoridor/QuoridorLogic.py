@@ -1,9 +1,7 @@
-import copy
 import os
 import sys
 
 import numpy as np
-from functools import partial
 
 from matplotlib import patches
 import matplotlib.pyplot as plt
@@ -12,132 +10,123 @@ sys.path.append(os.path.join(os.path.dirname(__file__), 'pathfind/build'))
 import QuoridorUtils
 
 
-class QuoridorBoard:
-    def __init__(self, n, board=None):
-        assert n >= 3
-
+# (dx, dy) of the pawn actions
+PAWN_TRANSLATIONS = (
+    # NORTH
+    (+0, +1),
+    # SOUTH
+    (+0, -1),
+    # EAST
+    (+1, +0),
+    # WEST
+    (-1, +0),
+    # JN
+    (+0, +2),
+    # JS
+    (+0, -2),
+    # JE
+    (+2, +0),
+    # JW
+    (-2, +0),
+    # JNE
+    (+1, +1),
+    # JSW
+    (-1, -1),
+    # JNW
+    (-1, +1),
+    # JSE
+    (+1, -1),
+)
+# index of the mirror of every pawn action by a horizontal flip
+PAWN_MIRROR = [PAWN_TRANSLATIONS.index((-dx, dy)) for dx, dy in PAWN_TRANSLATIONS]
+
+
+class BoardEncoder:
+    """
+    Encodes batches of boards as getBoard does, in float32 arrays of shape
+    (B, 2, n, n), (B, 2, n - 1, n - 1) and (B, 17) allocated once and grown
+    when a larger batch comes. The arrays returned are views of their first
+    rows, which torch.from_numpy wraps without copying; they are overwritten
+    by the next call.
+    """
+
+    def __init__(self, n, capacity=1):
         self.n = n
-        self.history = {}
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        self.capacity = capacity
+        self.boards = np.zeros((capacity, 2, self.n, self.n), np.float32)
+        self.walls = np.zeros((capacity, 2, self.n - 1, self.n - 1), np.float32)
+        self.values = np.zeros((capacity, 17), np.float32)
+
+    def rows(self, k):
+        if k > self.capacity:
+            self.allocate(max(k, 2 * self.capacity))
+        return self.boards[:k], self.walls[:k], self.values[:k]
 
-        midpoint_red = self.n // 2 + 1 - n % 2
-        midpoint_blue = self.n // 2 - 1 + n % 2
-        lastpoint = self.n - 1
+    def encode(self, boards):
+        """
+        Returns the encodings of a list of boards.
+        """
+        encodings = self.rows(len(boards))
+        QuoridorUtils.encodeStates([board.state for board in boards], *encodings)
+        return encodings
 
-        self.red_goal = lastpoint
-        self.blue_goal = 0
-        self.is_flipped = False
 
-        self.max_walls = (self.n + 1) ** 2 // 10
+class QuoridorBoard:
+    # The whole state lives in a native QuoridorUtils.QuoridorState, so
+    # copying a board or playing an action is a single call into the
+    # extension. The arrays are read-only numpy views over its buffer.
+    __slots__ = ('state',)
+
+    def __init__(self, n, board=None):
+        assert 3 <= n <= QuoridorUtils.MAX_BOARD_SIZE
+
         if board:
             self.setBoard(board)
-        else:
-            self.v_walls = np.zeros((self.n - 1, self.n - 1), np.int16)
-            self.h_walls = np.zeros((self.n - 1, self.n - 1), np.int16)
-            self.draw = False
-
-            self.paths_red, self.paths_blue = QuoridorUtils.getPathMatrices(self.v_walls, self.h_walls)
-            self.legal_vwalls = np.ones((self.n - 1, self.n - 1), np.int16)
-            self.legal_hwalls = np.ones((self.n - 1, self.n - 1), np.int16)
-
-            # red player
-            self.red_position = (midpoint_red, 0)
-            self.red_walls = self.max_walls
-
-            # blue player
-            self.blue_position = (midpoint_blue, lastpoint)
-            self.blue_walls = self.max_walls
-
-        self.actions = {
-            # NORTH
-            0: partial(self.move, dx=+0, dy=+1),
-            # SOUTH
-            1: partial(self.move, dx=+0, dy=-1),
-            # EAST
-            2: partial(self.move, dx=+1, dy=+0),
-            # WEST
-            3: partial(self.move, dx=-1, dy=+0),
-            # JN
-            4: partial(self.move, dx=+0, dy=+2),
-            # JS
-            5: partial(self.move, dx=+0, dy=-2),
-            # JE
-            6: partial(self.move, dx=+2, dy=+0),
-            # JW
-            7: partial(self.move, dx=-2, dy=+0),
-            # JNE
-            8: partial(self.move, dx=+1, dy=+1),
-            # JSW
-            9: partial(self.move, dx=-1, dy=-1),
-            # JNW
-            10: partial(self.move, dx=-1, dy=+1),
-            # JSE
-            11: partial(self.move, dx=+1, dy=-1),
-            # PLACE VERTICAL WALL
-            'vw': self.placeVerticalWall,
-            # PLACE HORIZONTAL WALL
-            'hw': self.placeHorizontalWall,
-        }
-
-        self.convert_action = [1, 0, 3, 2, 5, 4, 7, 6, 9, 8, 11, 10] + list(
-            np.flip(np.arange(12, 12 + (self.n - 1) ** 2).reshape((self.n - 1, self.n - 1)), (0, 1)).ravel()) + list(
-            np.flip(np.arange(12 + (self.n - 1) ** 2, 12 + 2 * (self.n - 1) ** 2).reshape((self.n - 1, self.n - 1)),
-                    (0, 1)).ravel())
+            return
+
+        self.state = QuoridorUtils.QuoridorState(n)
+
+    n = property(lambda self: self.state.n)
+    max_walls = property(lambda self: self.state.max_walls)
+    red_position = property(lambda self: self.state.red_position)
+    red_walls = property(lambda self: self.state.red_walls)
+    red_goal = property(lambda self: self.state.red_goal)
+    blue_position = property(lambda self: self.state.blue_position)
+    blue_walls = property(lambda self: self.state.blue_walls)
+    blue_goal = property(lambda self: self.state.blue_goal)
+    is_flipped = property(lambda self: self.state.is_flipped)
+    draw = property(lambda self: self.state.draw)
+    # Zobrist keys of the board and of its flipped form, updated on every change
+    zobrist = property(lambda self: self.state.zobrist)
+    zobrist_flipped = property(lambda self: self.state.zobrist_flipped)
+
+    walls = property(lambda self: self.state.walls)
+    paths = property(lambda self: self.state.paths)
+    v_walls = property(lambda self: self.state.walls[0])
+    h_walls = property(lambda self: self.state.walls[1])
+    legal_vwalls = property(lambda self: self.state.walls[2])
+    legal_hwalls = property(lambda self: self.state.walls[3])
+    paths_red = property(lambda self: self.state.paths[0])
+    paths_blue = property(lambda self: self.state.paths[1])
+
+    def copy(self):
+        board = QuoridorBoard.__new__(QuoridorBoard)
+        board.setBoard(self)
+        return board
 
     def getGameEnded(self, player):
-        # endgame_heuristic = True
-        # if endgame_heuristic:
-        #     dist_red = self.paths_red[self.red_position[0]][self.red_position[1]]
-        #     dist_blue = self.paths_blue[self.blue_position[0]][self.blue_position[1]]
-        #
-        #     if player == 1 and self.red_walls == 0 and self.blue_walls == 0 and dist_red < dist_blue:
-        #         return player
-        #     if player == -1 and self.red_walls == 0 and self.blue_walls == 0 and dist_blue < dist_red:
-        #         return -player
-
-        if self.red_position[1] == self.red_goal:
-            return player
-        elif self.blue_position[1] == self.blue_goal:
-            return -player
-        elif self.draw:
-            return -1e-3
-        return 0
-
-    def addToHistory(self):
-        s = self.getBoardHashable()
-        if s in self.history:
-            self.history[s] += 1
-        else:
-            self.history[s] = 1
+        return self.state.game_ended(player)
 
-        if self.history[s] > 2:
-            self.draw = True
+    def getRaceResult(self):
+        # Outcome of the pawn race for red to move once both players are out
+        # of walls, as getGameEnded(1), and 0 while any walls are left
+        return self.state.race_result()
 
     def getBoard(self):
-        # Boards
-        boards = np.zeros((2, self.n, self.n), dtype=int)
-        # Red position
-        red_board = np.zeros((self.n, self.n))
-        red_board[self.red_position[0], self.red_position[1]] = 1
-        boards[0] = red_board
-        # Blue position
-        blue_board = np.zeros((self.n, self.n))
-        blue_board[self.blue_position[0], self.blue_position[1]] = 1
-        boards[1] = blue_board
-
-        # Walls
-        walls = np.zeros((2, self.n - 1, self.n - 1), dtype=int)
-        walls[0] = self.v_walls
-        walls[1] = self.h_walls
-
-        # Values
-        values = np.append(self.shortestPathActions(),
-                           [self.red_walls / self.max_walls, self.blue_walls / self.max_walls,
-                            ((self.n ** 2 + 1) - self.paths_red[self.red_position[0]][self.red_position[1]]) / (
-                                    self.n ** 2 + 1),
-                            ((self.n ** 2 + 1) - self.paths_blue[self.blue_position[0]][self.blue_position[1]]) / (
-                                    self.n ** 2 + 1),
-                            float(self.draw)])
-        return boards, walls, values
+        return self.state.encode()
 
     def getBoardFlippedHorizontally(self):
         # Boards
@@ -156,60 +145,15 @@ class QuoridorBoard:
         walls[0] = np.flipud(self.v_walls)
         walls[1] = np.flipud(self.h_walls)
 
-        # Values
-        spa = self.shortestPathActions()
-        spa[2], spa[3] = spa[3], spa[2]
-        spa[6], spa[7] = spa[7], spa[6]
-        spa[8], spa[10] = spa[10], spa[8]
-        spa[9], spa[11] = spa[9], spa[11]
-        values = np.append(spa,
-                           [self.red_walls / self.max_walls, self.blue_walls / self.max_walls,
-                            ((self.n ** 2 + 1) - self.paths_red[(self.n - 1) - self.red_position[0]][
-                                self.red_position[1]]) / (self.n ** 2 + 1),
-                            ((self.n ** 2 + 1) - self.paths_blue[(self.n - 1) - self.blue_position[0]][
-                                self.blue_position[1]]) / (self.n ** 2 + 1),
-                            float(self.draw)])
+        # Values, with East and West swapped. The distances to the goals
+        # don't change.
+        values = self.getBoard()[2]
+        values[:12] = values[PAWN_MIRROR]
         return boards, walls, values
 
     def shortestPathActions(self):
-
-        pawn_actions = QuoridorUtils.getPawnActions(self.red_position[0], self.red_position[1],
-                                                    self.blue_position[0], self.blue_position[1],
-                                                    self.v_walls, self.h_walls)
-        pawn_translations = {
-            # NORTH
-            0: (+0, +1),
-            # SO
-            1: (+0, -1),
-            # EA
-            2: (+1, +0),
-            # WE
-            3: (-1, +0),
-            # JN
-            4: (+0, +2),
-            # JS
-            5: (+0, -2),
-            # JE
-            6: (+2, +0),
-            # JW
-            7: (-2, +0),
-            # JNE
-            8: (+1, +1),
-            # JSW
-            9: (-1, -1),
-            # JNW
-            10: (-1, +1),
-            # JSE
-            11: (+1, -1),
-        }
-
-        action_dists = np.zeros(12, dtype=float)
-        for i, p in enumerate(pawn_actions):
-            if p == 1:
-                x = self.red_position[0] + pawn_translations[i][0]
-                y = self.red_position[1] + pawn_translations[i][1]
-                action_dists[i] = ((self.n ** 2 + 1) - self.paths_red[x][y]) / (self.n ** 2 + 1)
-        return action_dists
+        # a copy of the values cached by the state until the board changes
+        return self.state.shortest_path_actions()
 
     def transformWalls(self, wall):
         res = np.zeros((self.n, self.n))
@@ -223,40 +167,10 @@ class QuoridorBoard:
                 self.h_walls.tostring(), self.draw)
 
     def setBoard(self, board):
-        self.history = copy.deepcopy(board.history)
-        self.v_walls = np.array(board.v_walls, copy=True)
-        self.h_walls = np.array(board.h_walls, copy=True)
-        self.draw = board.draw
-        self.paths_red = np.array(board.paths_red, copy=True)
-        self.paths_blue = np.array(board.paths_blue, copy=True)
-        self.is_flipped = board.is_flipped
-
-        self.legal_vwalls = np.array(board.legal_vwalls, copy=True)
-        self.legal_hwalls = np.array(board.legal_hwalls, copy=True)
-
-        self.red_position = board.red_position
-        self.red_walls = board.red_walls
-        self.red_goal = board.red_goal
-
-        self.blue_position = board.blue_position
-        self.blue_walls = board.blue_walls
-        self.blue_goal = board.blue_goal
+        self.state = board.state.clone()
 
     def flipBoard(self):
-        self.is_flipped = not self.is_flipped
-        self.red_position, self.blue_position = (self.n - 1 - self.blue_position[0],
-                                                 self.n - 1 - self.blue_position[1]), \
-                                                (self.n - 1 - self.red_position[0],
-                                                 self.n - 1 - self.red_position[1])
-        self.red_walls, self.blue_walls = self.blue_walls, self.red_walls
-        self.paths_blue, self.paths_red = self.paths_red, self.paths_blue
-
-        self.v_walls = np.flip(self.v_walls, (0, 1))
-        self.h_walls = np.flip(self.h_walls, (0, 1))
-        self.legal_vwalls = np.flip(self.legal_vwalls, (0, 1))
-        self.legal_hwalls = np.flip(self.legal_hwalls, (0, 1))
-        self.paths_red = np.flip(self.paths_red, (0, 1))
-        self.paths_blue = np.flip(self.paths_blue, (0, 1))
+        self.state.flip()
 
     def makeCanonical(self, player):
         if player != 1:
@@ -264,82 +178,13 @@ class QuoridorBoard:
         return self
 
     def getValidActions(self, player):
-        if player == 1:
-            pawn_actions = QuoridorUtils.getPawnActions(self.red_position[0], self.red_position[1],
-                                                        self.blue_position[0], self.blue_position[1],
-                                                        self.v_walls, self.h_walls)
-
-            # pawn_actions = 12 * [0]
-            if self.red_walls > 0:
-                wall_actions = list(np.concatenate((self.legal_vwalls.flatten(), self.legal_hwalls.flatten())))
-            else:
-                wall_actions = 2 * (self.n - 1) ** 2 * [0]
-        else:
-            pawn_actions = QuoridorUtils.getPawnActions(self.blue_position[0], self.blue_position[1],
-                                                        self.red_position[0], self.red_position[1],
-                                                        self.v_walls, self.h_walls)
-            if self.blue_walls > 0:
-                wall_actions = list(np.concatenate((self.legal_vwalls.flatten(), self.legal_hwalls.flatten())))
-            else:
-                wall_actions = 2 * (self.n - 1) ** 2 * [0]
-
-        actions = pawn_actions + wall_actions
-        if sum(actions) == 0:
+        actions = self.state.valid_actions(player)
+        if not actions.any():
             self.plot(save=False)
-        return actions
+        return actions.tolist()
 
     def executeAction(self, player, action):
-        self.addToHistory()
-        pawn_moves = 12
-        vertical_wall_moves = pawn_moves + (self.n - 1) ** 2
-        if player == -1:
-            action = self.convert_action[action]
-
-        # Pawn Moves
-        if 0 <= action < pawn_moves:
-            x, y = self.red_position if player == 1 else self.blue_position
-            self.actions[action](player, x, y)
-        else:
-            # Vertical Walls
-            if pawn_moves <= action < vertical_wall_moves:
-                x = int((action - pawn_moves) / (self.n - 1))
-                y = int((action - pawn_moves) % (self.n - 1))
-                self.actions['vw'](player, x, y)
-            # Horizontal Walls
-            else:
-                x = int((action - vertical_wall_moves) / (self.n - 1))
-                y = int((action - vertical_wall_moves) % (self.n - 1))
-                self.actions['hw'](player, x, y)
-
-        self.paths_red, self.paths_blue = QuoridorUtils.getPathMatrices(self.v_walls, self.h_walls)
-
-        if self.red_walls > 0 or self.blue_walls > 0:
-            self.legal_vwalls, self.legal_hwalls = QuoridorUtils.updateWallActions(
-                self.red_position[0], self.red_position[1], self.n // 2, self.red_goal,
-                self.blue_position[0], self.blue_position[1], self.n // 2, self.blue_goal,
-                self.v_walls, self.h_walls)
-
-    def move(self, player, x, y, dx=0, dy=0):
-        if player == 1:
-            self.red_position = (x + dx, y + dy)
-        else:
-            self.blue_position = (x + dx, y + dy)
-
-    def placeVerticalWall(self, player, x, y):
-        if player == 1:
-            self.red_walls -= 1
-        else:
-            self.blue_walls -= 1
-
-        self.v_walls[x, y] = 1
-
-    def placeHorizontalWall(self, player, x, y):
-        if player == 1:
-            self.red_walls -= 1
-        else:
-            self.blue_walls -= 1
-
-        self.h_walls[x, y] = 1
+        self.state.step(player, action)
 
     def plot(self, path=None, name=None, save=True, print_lw=True, print_pm=False, save_folder=None):
         if path is None:
@@ -1,6 +1,6 @@
 import numpy as np
 
-from alphazero_general.MCTS import MCTS
+from alphazero_general.MCTS import newMCTS
 from alphazero_general.utils import dotdict
 from quoridor.pytorch.NNet import NNetWrapper as nn
 from quoridor.pytorchv2.NNet import NNetWrapper as nnv2
@@ -73,13 +73,14 @@ class AlphaQuoridor:
                 'cpuct': 2.5,
                 'cpuct_base': 19652,
                 'cpuct_mult': 2,
+                'mcts_max_nodes': 100000,
             })
         else:
             self.args = args
 
         nnet = nn(self.game)
         nnet.load_checkpoint(folder=nn_folder, filename=nn_name)
-        self.nmcts = MCTS(self.game, nnet, args)
+        self.nmcts = newMCTS(self.game, nnet, self.args)
         self.temp = temp
 
     def play(self, board):
@@ -100,13 +101,14 @@ class AlphaQuoridorV2:
                 'cpuct': 2.5,
                 'cpuct_base': 19652,
                 'cpuct_mult': 2,
+                'mcts_max_nodes': 100000,
             })
         else:
             self.args = args
 
         nnet = nnv2(self.game)
         nnet.load_checkpoint(folder=nn_folder, filename=nn_name)
-        self.nmcts = MCTS(self.game, nnet, args)
+        self.nmcts = newMCTS(self.game, nnet, self.args)
         self.temp = temp
 
     def play(self, board):
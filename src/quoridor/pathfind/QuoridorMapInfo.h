@@ -2,15 +2,83 @@
 #define QUORIDOR_MAPINFO_H
 
 
+#include <cstdint>
+#include <stdexcept>
+#include <string>
 #include <vector>
 
 
+// Largest board side: a column of cells is packed in a uint64_t
+const int MAX_BOARD_SIZE = 64;
+
+// The walls of a board packed as bitboards: bit y of vwalls[x] (hwalls[x]) is set if there is a vertical
+// (horizontal) wall at (x, y), for boards with up to MAX_BOARD_SIZE cells per side. Built once per search,
+// search nodes only keep a pointer to it.
 struct QuoridorMapInfo {
-    int map_width;
-    int map_height;
-    std::vector<std::vector<int>> vwalls;
-    std::vector<std::vector<int>> hwalls;
+    int board_size;  // number of wall slots per side
+    std::vector<uint64_t> vwalls;
+    std::vector<uint64_t> hwalls;
+
+    // scratch space of the searches over this map
+    mutable std::vector<uint64_t> seen;
+    mutable std::vector<int> stack;
+
+    QuoridorMapInfo() : board_size(0) {}
+
+    QuoridorMapInfo(const std::vector<std::vector<int>> &v, const std::vector<std::vector<int>> &h)
+            : board_size((int) v.size()), vwalls(v.size() + 1, 0), hwalls(v.size() + 1, 0),
+              seen(v.size() + 1, 0) {
+        checkSize(board_size);
+        stack.reserve((board_size + 1) * (board_size + 1));
+        for (int x = 0; x < board_size; ++x) {
+            for (int y = 0; y < board_size; ++y) {
+                setVWall(x, y, v[x][y] == 1);
+                setHWall(x, y, h[x][y] == 1);
+            }
+        }
+    }
+
+    static void checkSize(int board_size) {
+        if (board_size + 1 > MAX_BOARD_SIZE)
+            throw std::invalid_argument("boards larger than " + std::to_string(MAX_BOARD_SIZE) + " are not supported");
+    }
+
+    // from C-contiguous board_size x board_size arrays
+    QuoridorMapInfo(const int16_t *v, const int16_t *h, int board_size)
+            : board_size(board_size), vwalls(board_size + 1, 0), hwalls(board_size + 1, 0),
+              seen(board_size + 1, 0) {
+        checkSize(board_size);
+        stack.reserve((board_size + 1) * (board_size + 1));
+        for (int x = 0; x < board_size; ++x) {
+            for (int y = 0; y < board_size; ++y) {
+                setVWall(x, y, v[x * board_size + y] == 1);
+                setHWall(x, y, h[x * board_size + y] == 1);
+            }
+        }
+    }
+
+    bool hasVWall(int x, int y) const { return (vwalls[x] >> y) & 1; }
+
+    bool hasHWall(int x, int y) const { return (hwalls[x] >> y) & 1; }
+
+    void setVWall(int x, int y, bool wall) {
+        vwalls[x] = (vwalls[x] & ~(uint64_t(1) << y)) | (uint64_t(wall) << y);
+    }
+
+    void setHWall(int x, int y, bool wall) {
+        hwalls[x] = (hwalls[x] & ~(uint64_t(1) << y)) | (uint64_t(wall) << y);
+    }
+
+    // If is blocked North of (x, y)
+    bool blockedNorth(int x, int y) const {
+        return (y >= board_size) || (y < 0) || (x < board_size && hasHWall(x, y)) || (x > 0 && hasHWall(x - 1, y));
+    }
+
+    // If is blocked East of (x, y)
+    bool blockedEast(int x, int y) const {
+        return (x >= board_size) || (x < 0) || (y < board_size && hasVWall(x, y)) || (y > 0 && hasVWall(x, y - 1));
+    }
 };
 
 
-#endif
\ No newline at end of file
+#endif
@@ -37,13 +37,13 @@ class QuoridorMapSearchNode
 public:
     int x;	 // the (x,y) positions of the node
     int y;	
-    struct QuoridorMapInfo map;
+    const QuoridorMapInfo *map;  // walls of the board, shared by all the nodes of a search
 
-    QuoridorMapSearchNode() { x = 0; y = 0; }
+    QuoridorMapSearchNode() { x = 0; y = 0; map = nullptr; }
     QuoridorMapSearchNode(int px, int py, const QuoridorMapInfo &map_input) {
         x = px;
         y = py;
-        map = map_input;
+        map = &map_input;
     }
 
     float GoalDistanceEstimate( QuoridorMapSearchNode &nodeGoal );
@@ -118,33 +118,33 @@ bool QuoridorMapSearchNode::GetSuccessors( AStarSearch<QuoridorMapSearchNode> *a
 
     // push each possible move except allowing the search to go backwards
     // NORTH
-    if(!hasHWN(map.hwalls, x, y)
+    if(!map->blockedNorth(x, y)
         && !((parent_x == x) && (parent_y == y+1)))
     {
-        QuoridorMapSearchNode NewNode = QuoridorMapSearchNode( x, y+1, map );
+        QuoridorMapSearchNode NewNode = QuoridorMapSearchNode( x, y+1, *map );
         astarsearch->AddSuccessor( NewNode );
     }
 
     // SOUTH
-    if( !hasHWN(map.hwalls, x, y-1)
+    if( !map->blockedNorth(x, y-1)
         && !((parent_x == x) && (parent_y == y-1)))
     {
-        QuoridorMapSearchNode NewNode = QuoridorMapSearchNode( x, y-1, map );
+        QuoridorMapSearchNode NewNode = QuoridorMapSearchNode( x, y-1, *map );
         astarsearch->AddSuccessor( NewNode );
     }
 
     // EAST
-    if( !hasVWE(map.vwalls, x, y)
+    if( !map->blockedEast(x, y)
         && !((parent_x == x+1) && (parent_y == y)))
     {
-        QuoridorMapSearchNode NewNode = QuoridorMapSearchNode( x+1, y, map );
+        QuoridorMapSearchNode NewNode = QuoridorMapSearchNode( x+1, y, *map );
         astarsearch->AddSuccessor( NewNode );
     }	
     // WEST
-    if( !hasVWE(map.vwalls, x-1, y)
+    if( !map->blockedEast(x-1, y)
         && !((parent_x == x-1) && (parent_y == y)))
     {
-        QuoridorMapSearchNode NewNode = QuoridorMapSearchNode(x-1, y, map);
+        QuoridorMapSearchNode NewNode = QuoridorMapSearchNode(x-1, y, *map);
         astarsearch->AddSuccessor(NewNode);
     }
     return true;
@@ -1,15 +1,30 @@
+#include <algorithm>
+#include <array>
+#include <cstring>
+#include <functional>
+#include <list>
 #include <iostream>
+#include <limits>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <random>
 #include <vector>
 #include <queue>
 #include <tuple>
+#include <unordered_map>
+#include <unordered_set>
 #include <stdio.h>
 #include <math.h>
 #include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
 #include <pybind11/stl.h>
 
 #include "QuoridorMapSearchNode.h"
 #include "QuoridorMapInfo.h"
 
+namespace py = pybind11;
+
 void printBoard(const std::vector<std::vector<int>> &board) {
     for (const auto &line : board) {
         for (const auto &e : line) {
@@ -31,9 +46,10 @@ void printBoard(const std::vector<std::vector<int>> &board) {
 //    return (x >= board_size) || (x<0) || (y < board_size && vwalls[x][y] == 1) || (y > 0 && vwalls[x][y-1] == 1);
 //}
 
+// Sets to 1 the valid pawn actions of the player in actions[0:12]
+template<class Actions>
 inline void setPawnActions(int player_x, int player_y, int opponent_x, int opponent_y,
-                           const std::vector<std::vector<int>> &vwalls, const std::vector<std::vector<int>> &hwalls,
-                           std::vector<int> &actions) {
+                           const QuoridorMapInfo &map, Actions &actions) {
     const int N = 0;
     const int S = 1;
     const int E = 2;
@@ -47,24 +63,23 @@ inline void setPawnActions(int player_x, int player_y, int opponent_x, int oppon
     const int NW = 10;
     const int SE = 11;
 
-    int board_size = (int) vwalls.size();
     //    NORTH
     // If nothing blocks north
-    if (!hasHWN(hwalls, player_x, player_y)) {
+    if (!map.blockedNorth(player_x, player_y)) {
         // If no player on north
         if ((player_x != opponent_x) || (player_y + 1 != opponent_y)) {
             actions[N] = 1;
         } else {
             // If nothing blocking jump north
-            if (!hasHWN(hwalls, player_x, player_y + 1)) {
+            if (!map.blockedNorth(player_x, player_y + 1)) {
                 actions[JN] = 1;
             } else {
                 // If nothing blocking north east
-                if (!hasVWE(vwalls, player_x, player_y + 1)) {
+                if (!map.blockedEast(player_x, player_y + 1)) {
                     actions[NE] = 1;
                 }
                 // If nothing blocking north west
-                if (!hasVWE(vwalls, player_x - 1, player_y + 1)) {
+                if (!map.blockedEast(player_x - 1, player_y + 1)) {
                     actions[NW] = 1;
                 }
             }
@@ -74,21 +89,21 @@ inline void setPawnActions(int player_x, int player_y, int opponent_x, int oppon
 
     //    SOUTH
     // If nothing blocks south
-    if (!hasHWN(hwalls, player_x, player_y - 1)) {
+    if (!map.blockedNorth(player_x, player_y - 1)) {
         // If no player on south
         if ((player_x != opponent_x) || (player_y - 1 != opponent_y)) {
             actions[S] = 1;
         } else {
             // If nothing blocking jump south
-            if (!hasHWN(hwalls, player_x, player_y - 2)) {
+            if (!map.blockedNorth(player_x, player_y - 2)) {
                 actions[JS] = 1;
             } else {
                 // If nothing blocking south east
-                if (!hasVWE(vwalls, player_x, player_y - 1)) {
+                if (!map.blockedEast(player_x, player_y - 1)) {
                     actions[SE] = 1;
                 }
                 // If nothing blocking south west
-                if (!hasVWE(vwalls, player_x - 1, player_y - 1)) {
+                if (!map.blockedEast(player_x - 1, player_y - 1)) {
                     actions[SW] = 1;
                 }
             }
@@ -98,21 +113,21 @@ inline void setPawnActions(int player_x, int player_y, int opponent_x, int oppon
 
     //    EAST
     // If nothing blocks east
-    if (!hasVWE(vwalls, player_x, player_y)) {
+    if (!map.blockedEast(player_x, player_y)) {
         // If no player on east
         if ((player_x + 1 != opponent_x) || (player_y != opponent_y)) {
             actions[E] = 1;
         } else {
             // If nothing blocking jump east
-            if (!hasVWE(vwalls, player_x + 1, player_y)) {
+            if (!map.blockedEast(player_x + 1, player_y)) {
                 actions[JE] = 1;
             } else {
                 // If nothing blocking north east
-                if (!hasHWN(hwalls, player_x + 1, player_y)) {
+                if (!map.blockedNorth(player_x + 1, player_y)) {
                     actions[NE] = 1;
                 }
                 // If nothing blocking south east
-                if (!hasHWN(hwalls, player_x + 1, player_y - 1)) {
+                if (!map.blockedNorth(player_x + 1, player_y - 1)) {
                     actions[SE] = 1;
                 }
             }
@@ -122,21 +137,21 @@ inline void setPawnActions(int player_x, int player_y, int opponent_x, int oppon
 
     //    WEST
     // If nothing blocks west
-    if (!hasVWE(vwalls, player_x - 1, player_y)) {
+    if (!map.blockedEast(player_x - 1, player_y)) {
         // If no player on west
         if ((player_x - 1 != opponent_x) || (player_y != opponent_y)) {
             actions[W] = 1;
         } else {
             // If nothing blocking jump west
-            if (!hasVWE(vwalls, player_x - 2, player_y)) {
+            if (!map.blockedEast(player_x - 2, player_y)) {
                 actions[JW] = 1;
             } else {
                 // If nothing blocking north west
-                if (!hasHWN(hwalls, player_x - 1, player_y)) {
+                if (!map.blockedNorth(player_x - 1, player_y)) {
                     actions[NW] = 1;
                 }
                 // If nothing blocking south west
-                if (!hasHWN(hwalls, player_x - 1, player_y - 1)) {
+                if (!map.blockedNorth(player_x - 1, player_y - 1)) {
                     actions[SW] = 1;
                 }
             }
@@ -149,7 +164,7 @@ inline std::vector<int> getPawnActions(int player_x, int player_y, int opponent_
                                        const std::vector<std::vector<int>> &vwalls,
                                        const std::vector<std::vector<int>> &hwalls) {
     std::vector<int> actions(12, 0);
-    setPawnActions(player_x, player_y, opponent_x, opponent_y, vwalls, hwalls, actions);
+    setPawnActions(player_x, player_y, opponent_x, opponent_y, QuoridorMapInfo(vwalls, hwalls), actions);
     return actions;
 }
 
@@ -171,11 +186,7 @@ inline bool pathExists(
 
     // Create an instance of the search class...
 
-    struct QuoridorMapInfo Map;
-    Map.vwalls = vwalls;
-    Map.hwalls = hwalls;
-    Map.map_width = vwalls[0].size();
-    Map.map_height = vwalls[0].size();
+    QuoridorMapInfo Map(vwalls, hwalls);
 
     AStarSearch<QuoridorMapSearchNode> astarsearch;
 
@@ -219,11 +230,7 @@ inline std::tuple<std::vector<int>, int> findPath(
 
     // Create an instance of the search class...
 
-    struct QuoridorMapInfo Map;
-    Map.vwalls = vwalls;
-    Map.hwalls = hwalls;
-    Map.map_width = vwalls[0].size();
-    Map.map_height = vwalls[0].size();
+    QuoridorMapInfo Map(vwalls, hwalls);
 
     AStarSearch<QuoridorMapSearchNode> astarsearch;
 
@@ -314,170 +321,419 @@ inline std::tuple<std::vector<int>, int> findPath(
 }
 
 
+typedef struct QNode {
+    int x;
+    int y;
+
+    QNode(int _x, int _y) : x(_x), y(_y) {}
+} QNode;
+
+// Nested vectors with the element access of the numpy array proxies, so the same code fills both
+struct NestedGrid {
+    std::vector<std::vector<int>> &grid;
+
+    int &operator()(int x, int y) { return grid[x][y]; }
+};
+
+template<class Grid>
+inline void calculatePathMatrix(const QuoridorMapInfo &map, Grid &path, queue<QNode> &q) {
+
+    while (!q.empty()) {
+        QNode n = q.front();
+        q.pop();
+        // check north neighbor
+        if (!map.blockedNorth(n.x, n.y) && (path(n.x, n.y + 1) > path(n.x, n.y) + 1)) {
+            q.push(QNode(n.x, n.y + 1));
+            path(n.x, n.y + 1) = path(n.x, n.y) + 1;
+        }
+        // check south neighbor
+        if (!map.blockedNorth(n.x, n.y - 1) && (path(n.x, n.y - 1) > path(n.x, n.y) + 1)) {
+            q.push(QNode(n.x, n.y - 1));
+            path(n.x, n.y - 1) = path(n.x, n.y) + 1;
+        }
+        // check east neighbor
+        if (!map.blockedEast(n.x, n.y) && (path(n.x + 1, n.y) > path(n.x, n.y) + 1)) {
+            q.push(QNode(n.x + 1, n.y));
+            path(n.x + 1, n.y) = path(n.x, n.y) + 1;
+        }
+        // check west neighbor
+        if (!map.blockedEast(n.x - 1, n.y) && (path(n.x - 1, n.y) > path(n.x, n.y) + 1)) {
+            q.push(QNode(n.x - 1, n.y));
+            path(n.x - 1, n.y) = path(n.x, n.y) + 1;
+        }
+    }
+}
+
+// Sets path to the distances from every cell to the row goal_y, board_size * board_size + 1 if unreachable
+template<class Grid>
+inline void setPathMatrix(const QuoridorMapInfo &map, int goal_y, Grid &path) {
+    int board_size = map.board_size + 1;
+    for (int i = 0; i < board_size; ++i)
+        for (int j = 0; j < board_size; ++j)
+            path(i, j) = board_size * board_size + 1;
+
+    queue<QNode> q;
+    for (int i = 0; i < board_size; ++i) {
+        path(i, goal_y) = 0;
+        q.push(QNode(i, goal_y));
+    }
+    calculatePathMatrix(map, path, q);
+}
+
+// Calls f(nx, ny) for the neighbours of (x, y) not separated from it by a wall
+template<class F>
+inline void forEachNeighbour(const QuoridorMapInfo &map, int x, int y, F f) {
+    if (!map.blockedNorth(x, y)) f(x, y + 1);
+    if (!map.blockedNorth(x, y - 1)) f(x, y - 1);
+    if (!map.blockedEast(x, y)) f(x + 1, y);
+    if (!map.blockedEast(x - 1, y)) f(x - 1, y);
+}
+
+// Updates path, set by setPathMatrix, after the wall (wx, wy) was added to map. The wall only removes edges, so
+// distances can only grow: the cells left without a neighbour one step closer to the goal, found by increasing
+// distance, are the only ones searched again, starting from the cells around them. The result is the one of
+// setPathMatrix.
+template<class Grid>
+inline void repairPathMatrix(const QuoridorMapInfo &map, int wx, int wy, bool is_vertical, Grid &path) {
+    int board_size = map.board_size + 1;
+    int unreachable = board_size * board_size + 1;
+    typedef std::pair<int, int> Entry;  // (distance, x * board_size + y)
+    std::priority_queue<Entry, std::vector<Entry>, std::greater<Entry>> queue;
+
+    // the cells whose shortest paths went through one of the two cut edges
+    int cut[2][4] = {{wx, wy, is_vertical ? wx + 1 : wx, is_vertical ? wy : wy + 1},
+                     {is_vertical ? wx : wx + 1, is_vertical ? wy + 1 : wy, wx + 1, wy + 1}};
+    for (auto &edge : cut) {
+        int da = path(edge[0], edge[1]);
+        int db = path(edge[2], edge[3]);
+        if (da == db + 1)
+            queue.push({da, edge[0] * board_size + edge[1]});
+        else if (db == da + 1)
+            queue.push({db, edge[2] * board_size + edge[3]});
+    }
+    if (queue.empty())
+        return;
+
+    // mark the cells that lost all their shortest paths, by increasing distance
+    std::vector<char> lost(board_size * board_size, 0);
+    std::vector<int> lost_cells;
+    while (!queue.empty()) {
+        int d = queue.top().first;
+        int x = queue.top().second / board_size;
+        int y = queue.top().second % board_size;
+        queue.pop();
+        if (lost[x * board_size + y])
+            continue;
+        bool supported = false;
+        forEachNeighbour(map, x, y, [&](int nx, int ny) {
+            supported = supported || (path(nx, ny) == d - 1 && !lost[nx * board_size + ny]);
+        });
+        if (supported)
+            continue;
+        lost[x * board_size + y] = 1;
+        lost_cells.push_back(x * board_size + y);
+        forEachNeighbour(map, x, y, [&](int nx, int ny) {
+            if (path(nx, ny) == d + 1 && !lost[nx * board_size + ny])
+                queue.push({d + 1, nx * board_size + ny});
+        });
+    }
+
+    // search them again from the cells around them, whose distances didn't change
+    for (int cell : lost_cells) {
+        int x = cell / board_size;
+        int y = cell % board_size;
+        int best = unreachable;
+        forEachNeighbour(map, x, y, [&](int nx, int ny) {
+            if (!lost[nx * board_size + ny] && path(nx, ny) < unreachable)
+                best = std::min(best, path(nx, ny) + 1);
+        });
+        path(x, y) = best;
+        if (best < unreachable)
+            queue.push({best, cell});
+    }
+    while (!queue.empty()) {
+        int d = queue.top().first;
+        int x = queue.top().second / board_size;
+        int y = queue.top().second % board_size;
+        queue.pop();
+        if (d > path(x, y))
+            continue;
+        forEachNeighbour(map, x, y, [&](int nx, int ny) {
+            if (lost[nx * board_size + ny] && path(nx, ny) > d + 1) {
+                path(nx, ny) = d + 1;
+                queue.push({d + 1, nx * board_size + ny});
+            }
+        });
+    }
+}
+
+// If a cell of the row goal_y can be reached from (x, y), by a depth-first search over the cells of the board
+inline bool rowReachable(int x, int y, int goal_y, const QuoridorMapInfo &map) {
+    std::vector<uint64_t> &seen = map.seen;
+    std::vector<int> &stack = map.stack;
+    int cells = map.board_size + 1;
+    std::fill(seen.begin(), seen.end(), 0);
+    stack.clear();
+
+    auto visit = [&](int cx, int cy) {
+        if (!((seen[cx] >> cy) & 1)) {
+            seen[cx] |= uint64_t(1) << cy;
+            stack.push_back(cx * cells + cy);
+        }
+    };
+    visit(x, y);
+    while (!stack.empty()) {
+        int cx = stack.back() / cells;
+        int cy = stack.back() % cells;
+        stack.pop_back();
+        if (cy == goal_y)
+            return true;
+        // the neighbour towards the goal is pushed last, so it is explored first
+        if (goal_y > cy) {
+            if (!map.blockedNorth(cx, cy - 1)) visit(cx, cy - 1);
+            if (!map.blockedEast(cx - 1, cy)) visit(cx - 1, cy);
+            if (!map.blockedEast(cx, cy)) visit(cx + 1, cy);
+            if (!map.blockedNorth(cx, cy)) visit(cx, cy + 1);
+        } else {
+            if (!map.blockedNorth(cx, cy)) visit(cx, cy + 1);
+            if (!map.blockedEast(cx - 1, cy)) visit(cx - 1, cy);
+            if (!map.blockedEast(cx, cy)) visit(cx + 1, cy);
+            if (!map.blockedNorth(cx, cy - 1)) visit(cx, cy - 1);
+        }
+    }
+    return false;
+}
+
+// If both pawns can still reach their goal row after placing the wall (wx, wy) on map
 inline bool canPlaceWall(int px, int py, int pgx, int pgy,
                          int ox, int oy, int ogx, int ogy,
                          int wx, int wy, bool is_vertical,
-                         std::vector<std::vector<int>> &vwalls,
-                         std::vector<std::vector<int>> &hwalls) {
+                         QuoridorMapInfo &map) {
     if (is_vertical)
-        vwalls[wx][wy] = 1;
+        map.setVWall(wx, wy, true);
     else
-        hwalls[wx][wy] = 1;
+        map.setHWall(wx, wy, true);
 
-    bool res = pathExists(px, py, pgx, pgy, vwalls, hwalls) && pathExists(ox, oy, ogx, ogy, vwalls, hwalls);
+    bool res = rowReachable(px, py, pgy, map) && rowReachable(ox, oy, ogy, map);
 
     if (is_vertical)
-        vwalls[wx][wy] = 0;
+        map.setVWall(wx, wy, false);
     else
-        hwalls[wx][wy] = 0;
+        map.setHWall(wx, wy, false);
 
     return res;
 }
 
+// The edges of one shortest path to the goal of each pawn. A wall that cuts none of them leaves both pawns a
+// path, so only the walls cutting them need a search.
+struct ShortestPaths {
+    int board_size;
+    std::vector<char> north;  // the edge between (x, y) and (x, y + 1) is on a path
+    std::vector<char> east;  // the edge between (x, y) and (x + 1, y) is on a path
+
+    ShortestPaths(int px, int py, int pgy, int ox, int oy, int ogy, const QuoridorMapInfo &map) {
+        board_size = map.board_size + 1;
+        north.assign(board_size * board_size, 0);
+        east.assign(board_size * board_size, 0);
+        mark(px, py, pgy, map);
+        mark(ox, oy, ogy, map);
+    }
+
+    void mark(int x, int y, int goal_y, const QuoridorMapInfo &map) {
+        std::vector<std::vector<int>> path(board_size, std::vector<int>(board_size));
+        NestedGrid grid{path};
+        setPathMatrix(map, goal_y, grid);
+
+        while (path[x][y] > 0) {
+            int next = path[x][y] - 1;
+            if (!map.blockedNorth(x, y) && path[x][y + 1] == next) {
+                north[x * board_size + y] = 1;
+                y += 1;
+            } else if (!map.blockedNorth(x, y - 1) && path[x][y - 1] == next) {
+                north[x * board_size + y - 1] = 1;
+                y -= 1;
+            } else if (!map.blockedEast(x, y) && path[x + 1][y] == next) {
+                east[x * board_size + y] = 1;
+                x += 1;
+            } else if (!map.blockedEast(x - 1, y) && path[x - 1][y] == next) {
+                east[(x - 1) * board_size + y] = 1;
+                x -= 1;
+            } else {
+                break;  // no path to the goal
+            }
+        }
+    }
+
+    // If the wall (x, y) blocks an edge of the paths
+    bool cuts(int x, int y, bool is_vertical) const {
+        if (is_vertical)
+            return east[x * board_size + y] || east[x * board_size + y + 1];
+        return north[x * board_size + y] || north[(x + 1) * board_size + y];
+    }
+};
+
+// If the wall (x, y) overlaps a wall already placed
+inline bool wallOverlaps(int x, int y, bool is_vertical, const QuoridorMapInfo &map) {
+    int board_size = map.board_size;
+    if (is_vertical)
+        return map.hasVWall(x, y) ||
+               (y + 1 < board_size && map.hasVWall(x, y + 1)) ||
+               (y - 1 >= 0 && map.hasVWall(x, y - 1)) ||
+               map.hasHWall(x, y);
+    return map.hasHWall(x, y) ||
+           (x + 1 < board_size && map.hasHWall(x + 1, y)) ||
+           (x - 1 >= 0 && map.hasHWall(x - 1, y)) ||
+           map.hasVWall(x, y);
+}
+
+// Number of the ends and the middle of the wall (x, y) touching a wall or the border. A wall touching
+// less than two cannot close a region of the board.
+inline int wallConnections(int x, int y, bool is_vertical, const QuoridorMapInfo &map) {
+    int board_size = map.board_size;
+    int i = x;
+    int j = y;
+    int connections = 0;
+    if (is_vertical) {
+        if ((j + 1 >= board_size) ||
+            map.hasHWall(i, j + 1) ||
+            (i - 1 >= 0 && map.hasHWall(i - 1, j + 1)) ||
+            (i + 1 < board_size && map.hasHWall(i + 1, j + 1)) ||
+            (j + 2 < board_size && map.hasVWall(i, j + 2)))
+            connections += 1;
+        if ((j - 1 < 0) ||
+            map.hasHWall(i, j - 1) ||
+            (i - 1 >= 0 && map.hasHWall(i - 1, j - 1)) ||
+            (i + 1 < board_size && map.hasHWall(i + 1, j - 1)) ||
+            (j - 2 >= 0 && map.hasVWall(i, j - 2)))
+            connections += 1;
+        if ((i - 1 >= 0 && map.hasHWall(i - 1, j)) ||
+            (i + 1 < board_size && map.hasHWall(i + 1, j)))
+            connections += 1;
+    } else {
+        if ((i + 1 >= board_size) ||
+            map.hasVWall(i + 1, j) ||
+            (j - 1 >= 0 && map.hasVWall(i + 1, j - 1)) ||
+            (j + 1 < board_size && map.hasVWall(i + 1, j + 1)) ||
+            (i + 2 < board_size && map.hasHWall(i + 2, j)))
+            connections += 1;
+        if ((i - 1 < 0) ||
+            map.hasVWall(i - 1, j) ||
+            (j - 1 >= 0 && map.hasVWall(i - 1, j - 1)) ||
+            (j + 1 < board_size && map.hasVWall(i - 1, j + 1)) ||
+            (i - 2 >= 0 && map.hasHWall(i - 2, j)))
+            connections += 1;
+        if ((j - 1 >= 0 && map.hasVWall(i, j - 1)) ||
+            (j + 1 < board_size && map.hasVWall(i, j + 1)))
+            connections += 1;
+    }
+    return connections;
+}
+
+inline bool isWallLegal(int px, int py, int pgx, int pgy,
+                        int ox, int oy, int ogx, int ogy,
+                        int wx, int wy, bool is_vertical,
+                        QuoridorMapInfo &map) {
+    return !wallOverlaps(wx, wy, is_vertical, map) &&
+           (wallConnections(wx, wy, is_vertical, map) < 2 ||
+            canPlaceWall(px, py, pgx, pgy, ox, oy, ogx, ogy, wx, wy, is_vertical, map));
+}
+
+template<class Grid>
 inline void setWallActions(int px, int py, int pgx, int pgy,
                            int ox, int oy, int ogx, int ogy,
-                           std::vector<std::vector<int>> &vwalls,
-                           std::vector<std::vector<int>> &hwalls,
-                           std::vector<std::vector<int>> &vwall_actions,
-                           std::vector<std::vector<int>> &hwall_actions) {
-    int board_size = (int) vwalls.size();
+                           QuoridorMapInfo &map,
+                           Grid &vwall_actions,
+                           Grid &hwall_actions) {
+    int board_size = map.board_size;
+    ShortestPaths paths(px, py, pgy, ox, oy, ogy, map);
     for (int i = 0; i < board_size; ++i) {
         for (int j = 0; j < board_size; ++j) {
-            // Vwalls
-            if ((vwalls[i][j] == 0) &&
-                (j + 1 >= board_size || vwalls[i][j + 1] == 0) &&
-                (j - 1 < 0 || vwalls[i][j - 1] == 0) &&
-                (hwalls[i][j] == 0)) {
-
-                int connections = 0;
-                if ((j + 1 >= board_size) ||
-                    (hwalls[i][j + 1] == 1) ||
-                    (i - 1 >= 0 && hwalls[i - 1][j + 1] == 1) ||
-                    (i + 1 < board_size && hwalls[i + 1][j + 1] == 1) ||
-                    (j + 2 < board_size && vwalls[i][j + 2] == 1))
-                    connections += 1;
-                if ((j - 1 < 0) ||
-                    (hwalls[i][j - 1] == 1) ||
-                    (i - 1 >= 0 && hwalls[i - 1][j - 1] == 1) ||
-                    (i + 1 < board_size && hwalls[i + 1][j - 1] == 1) ||
-                    (j - 2 >= 0 && vwalls[i][j - 2] == 1))
-                    connections += 1;
-                if ((i - 1 >= 0 && hwalls[i - 1][j] == 1) ||
-                    (i + 1 < board_size && hwalls[i + 1][j] == 1))
-                    connections += 1;
-
-                if (connections < 2 ||
-                    canPlaceWall(px, py, pgx, pgy, ox, oy, ogx, ogy, i, j, true, vwalls, hwalls)) {
-                    vwall_actions[i][j] = 1;
-                }
-            }
-
-            // Hwalls
-            if ((hwalls[i][j] == 0) &&
-                (i + 1 >= board_size || hwalls[i + 1][j] == 0) &&
-                (i - 1 < 0 || hwalls[i - 1][j] == 0) &&
-                (vwalls[i][j] == 0)) {
-
-                int connections = 0;
-                if ((i + 1 >= board_size) ||
-                    (vwalls[i + 1][j] == 1) ||
-                    (j - 1 >= 0 && vwalls[i + 1][j - 1] == 1) ||
-                    (j + 1 < board_size && vwalls[i + 1][j + 1] == 1) ||
-                    (i + 2 < board_size && hwalls[i + 2][j] == 1))
-                    connections += 1;
-
-                if ((i - 1 < 0) ||
-                    (vwalls[i - 1][j] == 1) ||
-                    (j - 1 >= 0 && vwalls[i - 1][j - 1] == 1) ||
-                    (j + 1 < board_size && vwalls[i - 1][j + 1] == 1) ||
-                    (i - 2 >= 0 && hwalls[i - 2][j] == 1))
-                    connections += 1;
-
-                if ((j - 1 >= 0 && vwalls[i][j - 1] == 1) ||
-                    (j + 1 < board_size && vwalls[i][j + 1] == 1))
-                    connections += 1;
-
-                if (connections < 2 ||
-                    canPlaceWall(px, py, pgx, pgy, ox, oy, ogx, ogy, i, j, false, vwalls, hwalls)) {
-                    hwall_actions[i][j] = 1;
-                }
+            for (bool is_vertical : {true, false}) {
+                auto &actions = is_vertical ? vwall_actions : hwall_actions;
+                actions(i, j) = !wallOverlaps(i, j, is_vertical, map) &&
+                                (!paths.cuts(i, j, is_vertical) ||
+                                 wallConnections(i, j, is_vertical, map) < 2 ||
+                                 canPlaceWall(px, py, pgx, pgy, ox, oy, ogx, ogy, i, j, is_vertical, map));
             }
         }
     }
 }
 
-inline void updateWallActions_(int px, int py, int pgx, int pgy,
-                               int ox, int oy, int ogx, int ogy,
-                               std::vector<std::vector<int>> &vwalls,
-                               std::vector<std::vector<int>> &hwalls,
-                               std::vector<std::vector<int>> &vwall_actions,
-                               std::vector<std::vector<int>> &hwall_actions) {
-    int board_size = (int) vwalls.size();
+// Updates the legal walls after a wall was placed, given the legal walls before it. A wall illegal before stays
+// illegal, and a legal one can only become illegal if it overlaps the new wall or cuts a shortest path of a pawn.
+template<class Grid>
+inline void setWallActionsAfterWall(int px, int py, int pgx, int pgy,
+                                    int ox, int oy, int ogx, int ogy,
+                                    QuoridorMapInfo &map,
+                                    Grid &vwall_actions,
+                                    Grid &hwall_actions) {
+    int board_size = map.board_size;
+    ShortestPaths paths(px, py, pgy, ox, oy, ogy, map);
     for (int i = 0; i < board_size; ++i) {
         for (int j = 0; j < board_size; ++j) {
-            // Vwalls
-            if ((vwalls[i][j] == 0) &&
-                (j + 1 >= board_size || vwalls[i][j + 1] == 0) &&
-                (j - 1 < 0 || vwalls[i][j - 1] == 0) &&
-                (hwalls[i][j] == 0)) {
-
-                int connections = 0;
-                if ((j + 1 >= board_size) ||
-                    (hwalls[i][j + 1] == 1) ||
-                    (i - 1 >= 0 && hwalls[i - 1][j + 1] == 1) ||
-                    (i + 1 < board_size && hwalls[i + 1][j + 1] == 1) ||
-                    (j + 2 < board_size && vwalls[i][j + 2] == 1))
-                    connections += 1;
-                if ((j - 1 < 0) ||
-                    (hwalls[i][j - 1] == 1) ||
-                    (i - 1 >= 0 && hwalls[i - 1][j - 1] == 1) ||
-                    (i + 1 < board_size && hwalls[i + 1][j - 1] == 1) ||
-                    (j - 2 >= 0 && vwalls[i][j - 2] == 1))
-                    connections += 1;
-                if ((i - 1 >= 0 && hwalls[i - 1][j] == 1) ||
-                    (i + 1 < board_size && hwalls[i + 1][j] == 1))
-                    connections += 1;
-
-                if (connections < 2 ||
-                    canPlaceWall(px, py, pgx, pgy, ox, oy, ogx, ogy, i, j, true, vwalls, hwalls)) {
-                    vwall_actions[i][j] = 1;
-                }
-            }
-
-            // Hwalls
-            if ((hwalls[i][j] == 0) &&
-                (i + 1 >= board_size || hwalls[i + 1][j] == 0) &&
-                (i - 1 < 0 || hwalls[i - 1][j] == 0) &&
-                (vwalls[i][j] == 0)) {
-
-                int connections = 0;
-                if ((i + 1 >= board_size) ||
-                    (vwalls[i + 1][j] == 1) ||
-                    (j - 1 >= 0 && vwalls[i + 1][j - 1] == 1) ||
-                    (j + 1 < board_size && vwalls[i + 1][j + 1] == 1) ||
-                    (i + 2 < board_size && hwalls[i + 2][j] == 1))
-                    connections += 1;
-
-                if ((i - 1 < 0) ||
-                    (vwalls[i - 1][j] == 1) ||
-                    (j - 1 >= 0 && vwalls[i - 1][j - 1] == 1) ||
-                    (j + 1 < board_size && vwalls[i - 1][j + 1] == 1) ||
-                    (i - 2 >= 0 && hwalls[i - 2][j] == 1))
-                    connections += 1;
-
-                if ((j - 1 >= 0 && vwalls[i][j - 1] == 1) ||
-                    (j + 1 < board_size && vwalls[i][j + 1] == 1))
-                    connections += 1;
-
-                if (connections < 2 ||
-                    canPlaceWall(px, py, pgx, pgy, ox, oy, ogx, ogy, i, j, false, vwalls, hwalls)) {
-                    hwall_actions[i][j] = 1;
-                }
+            for (bool is_vertical : {true, false}) {
+                auto &actions = is_vertical ? vwall_actions : hwall_actions;
+                if (actions(i, j) != 1)
+                    continue;
+                if (wallOverlaps(i, j, is_vertical, map))
+                    actions(i, j) = 0;
+                else if (paths.cuts(i, j, is_vertical) && wallConnections(i, j, is_vertical, map) >= 2)
+                    actions(i, j) = canPlaceWall(px, py, pgx, pgy, ox, oy, ogx, ogy, i, j, is_vertical, map);
             }
         }
     }
 }
 
+// Tests again the walls blocking the edge between the neighbouring cells (ax, ay) and (bx, by).
+template<class Grid>
+inline void setWallsBlocking(int ax, int ay, int bx, int by,
+                             int px, int py, int pgx, int pgy,
+                             int ox, int oy, int ogx, int ogy,
+                             QuoridorMapInfo &map,
+                             Grid &vwall_actions,
+                             Grid &hwall_actions) {
+    int board_size = map.board_size;
+    int x = std::min(ax, bx);
+    int y = std::min(ay, by);
+    bool is_vertical = ay == by;
+    for (int k = 0; k < 2; ++k) {
+        // a vertical wall (x, y) or (x, y - 1) blocks the east of (x, y), a horizontal wall (x, y) or
+        // (x - 1, y) blocks its north
+        int wx = is_vertical ? x : x - k;
+        int wy = is_vertical ? y - k : y;
+        if (wx < 0 || wx >= board_size || wy < 0 || wy >= board_size)
+            continue;
+        auto &actions = is_vertical ? vwall_actions : hwall_actions;
+        actions(wx, wy) = isWallLegal(px, py, pgx, pgy, ox, oy, ogx, ogy, wx, wy, is_vertical, map);
+    }
+}
+
+// Updates the legal walls after the pawn p moved from (from_x, from_y), given the legal walls before the move.
+// The walls didn't change, so only the walls separating both positions of p can change their legality.
+template<class Grid>
+inline void setWallActionsAfterMove(int px, int py, int pgx, int pgy,
+                                    int ox, int oy, int ogx, int ogy,
+                                    int from_x, int from_y,
+                                    QuoridorMapInfo &map,
+                                    Grid &vwall_actions,
+                                    Grid &hwall_actions) {
+    if (std::abs(px - from_x) + std::abs(py - from_y) == 1) {
+        setWallsBlocking(from_x, from_y, px, py, px, py, pgx, pgy, ox, oy, ogx, ogy,
+                         map, vwall_actions, hwall_actions);
+    } else {
+        // jumps go through the cell of the opponent
+        setWallsBlocking(from_x, from_y, ox, oy, px, py, pgx, pgy, ox, oy, ogx, ogy,
+                         map, vwall_actions, hwall_actions);
+        setWallsBlocking(ox, oy, px, py, px, py, pgx, pgy, ox, oy, ogx, ogy,
+                         map, vwall_actions, hwall_actions);
+    }
+}
+
+
+/*
+ * Functions taking and returning nested lists
+ */
+
 inline std::tuple<std::vector<std::vector<int>>, std::vector<std::vector<int>>>
 getWallActions(int px, int py, int pgx, int pgy,
                int ox, int oy, int ogx, int ogy,
@@ -488,8 +744,11 @@ getWallActions(int px, int py, int pgx, int pgy,
     int board_size = (int) vwalls.size();
     std::vector<std::vector<int>> vwall_actions(board_size, std::vector<int>(board_size, 0));
     std::vector<std::vector<int>> hwall_actions(board_size, std::vector<int>(board_size, 0));
-    if (num_walls > 0)
-        setWallActions(px, py, pgx, pgy, ox, oy, ogx, ogy, vwalls, hwalls, vwall_actions, hwall_actions);
+    if (num_walls > 0) {
+        QuoridorMapInfo map(vwalls, hwalls);
+        NestedGrid vgrid{vwall_actions}, hgrid{hwall_actions};
+        setWallActions(px, py, pgx, pgy, ox, oy, ogx, ogy, map, vgrid, hgrid);
+    }
 
     return {vwall_actions, hwall_actions};
 }
@@ -499,15 +758,7 @@ updateWallActions(int px, int py, int pgx, int pgy,
                   int ox, int oy, int ogx, int ogy,
                   std::vector<std::vector<int>> &vwalls,
                   std::vector<std::vector<int>> &hwalls) {
-
-    int board_size = (int) vwalls.size();
-    std::vector<std::vector<int>> vwall_actions(board_size, std::vector<int>(board_size, 0));
-    std::vector<std::vector<int>> hwall_actions(board_size, std::vector<int>(board_size, 0));
-    updateWallActions_(px, py, pgx, pgy, ox, oy, ogx, ogy,
-                       vwalls, hwalls,
-                       vwall_actions, hwall_actions);
-
-    return {vwall_actions, hwall_actions};
+    return getWallActions(px, py, pgx, pgy, ox, oy, ogx, ogy, vwalls, hwalls, 1);
 }
 
 inline std::vector<int> getValidActions(int px, int py, int pgx, int pgy,
@@ -518,12 +769,14 @@ inline std::vector<int> getValidActions(int px, int py, int pgx, int pgy,
     int board_size = (int) vwalls.size();
     int action_size = 12 + 2 * board_size * board_size;
     std::vector<int> actions(action_size, 0);
-    setPawnActions(px, py, ox, oy, vwalls, hwalls, actions);
+    QuoridorMapInfo map(vwalls, hwalls);
+    setPawnActions(px, py, ox, oy, map, actions);
 
     if (num_walls > 0) {
         std::vector<std::vector<int>> vwall_actions(board_size, std::vector<int>(board_size, 0));
         std::vector<std::vector<int>> hwall_actions(board_size, std::vector<int>(board_size, 0));
-        setWallActions(px, py, pgx, pgy, ox, oy, ogx, ogy, vwalls, hwalls, vwall_actions, hwall_actions);
+        NestedGrid vgrid{vwall_actions}, hgrid{hwall_actions};
+        setWallActions(px, py, pgx, pgy, ox, oy, ogx, ogy, map, vgrid, hgrid);
 
         for (int i = 0; i < board_size; ++i) {
             for (int j = 0; j < board_size; ++j) {
@@ -539,76 +792,954 @@ inline std::vector<int> getValidActions(int px, int py, int pgx, int pgy,
     return actions;
 }
 
+inline std::tuple<std::vector<std::vector<int>>, std::vector<std::vector<int>>> getPathMatrices(
+        const std::vector<std::vector<int>> &vwalls,
+        const std::vector<std::vector<int>> &hwalls) {
+    int board_size = (int) hwalls.size() + 1;
+    std::vector<std::vector<int>> path_red(board_size, std::vector<int>(board_size));
+    std::vector<std::vector<int>> path_blue(board_size, std::vector<int>(board_size));
+    QuoridorMapInfo map(vwalls, hwalls);
+    NestedGrid red{path_red}, blue{path_blue};
+    setPathMatrix(map, board_size - 1, red);
+    setPathMatrix(map, 0, blue);
 
-typedef struct QNode {
-    int x;
-    int y;
+    return {path_red, path_blue};
+}
 
-    QNode(int _x, int _y) : x(_x), y(_y) {}
-} QNode;
 
-inline void calculatePathMatrix(
-        const std::vector<std::vector<int>> &vwalls,
-        const std::vector<std::vector<int>> &hwalls,
-        std::vector<std::vector<int>> &path,
-        queue<QNode> &q) {
+/*
+ * Native game state
+ */
+
+// A C-contiguous size x size int16 array, with the element access of NestedGrid
+struct FlatGrid {
+    int16_t *data;
+    int size;
+
+    int16_t &operator()(int x, int y) { return data[x * size + y]; }
+};
+
+// (dx, dy) of the pawn actions, in the order of PAWN_TRANSLATIONS in QuoridorLogic.py
+const int PAWN_DX[12] = {+0, +0, +1, -1, +0, +0, +2, -2, +1, -1, -1, +1};
+const int PAWN_DY[12] = {+1, -1, +0, +0, +2, -2, +0, +0, +1, -1, +1, -1};
+
+// The random 64-bit keys of every pawn position, wall, number of walls left and of the draw flag, shared by all
+// the states of size n.
+struct ZobristTable {
+    std::vector<uint64_t> red;  // n * n
+    std::vector<uint64_t> blue;  // n * n
+    std::vector<uint64_t> vwalls;  // (n - 1) * (n - 1)
+    std::vector<uint64_t> hwalls;  // (n - 1) * (n - 1)
+    std::vector<uint64_t> red_walls;  // max_walls + 1
+    std::vector<uint64_t> blue_walls;  // max_walls + 1
+    uint64_t draw;
+
+    ZobristTable(int n, int max_walls) {
+        std::mt19937_64 rng(n);
+        auto keys = [&rng](int size) {
+            std::vector<uint64_t> res(size);
+            for (auto &key : res)
+                key = rng();
+            return res;
+        };
+        red = keys(n * n);
+        blue = keys(n * n);
+        vwalls = keys((n - 1) * (n - 1));
+        hwalls = keys((n - 1) * (n - 1));
+        red_walls = keys(max_walls + 1);
+        blue_walls = keys(max_walls + 1);
+        draw = rng();
+    }
 
-    while (!q.empty()) {
-        QNode n = q.front();
-        q.pop();
-//        std::cout << "Pop: " <<  n.x << ' '<<  n.y << '\n';
-        // check north neighbor
-        if (!hasHWN(hwalls, n.x, n.y) && (path[n.x][n.y + 1] > path[n.x][n.y] + 1)) {
-            q.push(QNode(n.x, n.y + 1));
+    static std::shared_ptr<const ZobristTable> of(int n, int max_walls) {
+        static std::mutex mutex;
+        static std::map<int, std::shared_ptr<const ZobristTable>> tables;
+        std::lock_guard<std::mutex> lock(mutex);
+        auto &table = tables[n];
+        if (!table)
+            table = std::make_shared<const ZobristTable>(n, max_walls);
+        return table;
+    }
+};
+
+// An entry of the repetition history: the state zobrist key, the number of times it has been seen so far and the
+// previous entry. Entries are never modified, so a state shares its history with the states cloned from it.
+struct HistoryNode {
+    uint64_t key;
+    int count;
+    std::shared_ptr<const HistoryNode> parent;
+};
+
+// The outcomes of the pawn race left once both players are out of walls, for every position of the pawns and
+// player to move over fixed walls, solved by retrograde analysis. A position is won when its player can force
+// reaching the goal row, lost when the opponent can, and drawn when neither can, which ends in a repetition.
+struct RaceTable {
+    int n;
+    int red_goal, blue_goal;
+    std::vector<uint64_t> vwalls;
+    std::vector<uint64_t> hwalls;
+    std::vector<int8_t> outcomes;  // 1 if the player to move wins, -1 if it loses, 0 if drawn
+
+    RaceTable(const QuoridorMapInfo &map, int n, int red_goal, int blue_goal)
+            : n(n), red_goal(red_goal), blue_goal(blue_goal), vwalls(map.vwalls), hwalls(map.hwalls),
+              outcomes(2 * n * n * n * n, 0) {
+        int cells = n * n;
+        int size = (int) outcomes.size();
+        std::vector<int> degree(size, 0);
+        std::vector<char> solved(size, 0);
+        std::vector<int> queue;
+
+        // the positions reached by every move, grouped by reached position to walk the moves backwards
+        std::vector<std::pair<int, int>> moves;
+        for (int turn = 0; turn < 2; ++turn) {
+            for (int red = 0; red < cells; ++red) {
+                for (int blue = 0; blue < cells; ++blue) {
+                    if (red == blue)
+                        continue;
+                    int id = index(turn, red, blue);
+                    bool red_won = red % n == red_goal;
+                    bool blue_won = blue % n == blue_goal;
+                    if (red_won || blue_won) {
+                        // the player who just moved won
+                        solved[id] = 1;
+                        outcomes[id] = red_won == blue_won ? 0 : (red_won == (turn == 0) ? 1 : -1);
+                        queue.push_back(id);
+                        continue;
+                    }
+                    int from = turn == 0 ? red : blue;
+                    int other = turn == 0 ? blue : red;
+                    int16_t actions[12] = {0};
+                    setPawnActions(from / n, from % n, other / n, other % n, map, actions);
+                    for (int a = 0; a < 12; ++a) {
+                        if (actions[a] != 1)
+                            continue;
+                        int to = from + PAWN_DX[a] * n + PAWN_DY[a];
+                        moves.emplace_back(turn == 0 ? index(1, to, blue) : index(0, red, to), id);
+                        degree[id] += 1;
+                    }
+                }
+            }
+        }
+        std::sort(moves.begin(), moves.end());
+        std::vector<int> first(size + 1, 0);
+        for (const auto &move : moves)
+            first[move.first + 1] += 1;
+        for (int id = 0; id < size; ++id)
+            first[id + 1] += first[id];
+
+        for (size_t i = 0; i < queue.size(); ++i) {
+            int id = queue[i];
+            if (outcomes[id] == 0)
+                continue;
+            for (int m = first[id]; m < first[id + 1]; ++m) {
+                int previous = moves[m].second;
+                if (solved[previous])
+                    continue;
+                // a move to a lost position wins, and a position whose moves all reach won positions is lost
+                if (outcomes[id] == -1 || --degree[previous] == 0) {
+                    solved[previous] = 1;
+                    outcomes[previous] = outcomes[id] == -1 ? 1 : -1;
+                    queue.push_back(previous);
+                }
+            }
+        }
+    }
+
+    int index(int turn, int red, int blue) const { return (turn * n * n + red) * n * n + blue; }
+
+    // The outcome for the player to move, red if turn is 0
+    int outcome(int turn, int red_x, int red_y, int blue_x, int blue_y) const {
+        return outcomes[index(turn, red_x * n + red_y, blue_x * n + blue_y)];
+    }
 
-//            std::cout << "Add: " <<  n.x << ' '<<  n.y+1 << '\n';
-            path[n.x][n.y + 1] = path[n.x][n.y] + 1;
+    bool matches(const QuoridorMapInfo &map, int size, int red, int blue) const {
+        return n == size && red_goal == red && blue_goal == blue && vwalls == map.vwalls && hwalls == map.hwalls;
+    }
+
+    // The table of the walls of map, solved on the first request and kept among the most recently used ones
+    static std::shared_ptr<const RaceTable> of(const QuoridorMapInfo &map, int n, int red_goal, int blue_goal) {
+        static const size_t capacity = 64;
+        static std::mutex mutex;
+        static std::list<std::shared_ptr<const RaceTable>> tables;
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            for (auto it = tables.begin(); it != tables.end(); ++it) {
+                if ((*it)->matches(map, n, red_goal, blue_goal)) {
+                    tables.splice(tables.begin(), tables, it);
+                    return tables.front();
+                }
+            }
         }
-        // check south neighbor
-        if (!hasHWN(hwalls, n.x, n.y - 1) && (path[n.x][n.y - 1] > path[n.x][n.y] + 1)) {
-            q.push(QNode(n.x, n.y - 1));
-//            std::cout << "Add: " <<  n.x << ' '<<  n.y+1 << '\n';
-            path[n.x][n.y - 1] = path[n.x][n.y] + 1;
+        auto table = std::make_shared<const RaceTable>(map, n, red_goal, blue_goal);
+        std::lock_guard<std::mutex> lock(mutex);
+        tables.push_front(table);
+        if (tables.size() > capacity)
+            tables.pop_back();
+        return table;
+    }
+};
+
+// The whole state of a game: pawns, walls left, walls, legal walls, path matrices, zobrist keys and repetition
+// history. The walls, legal walls and path matrices live in a single int16 buffer with the layout of
+// QuoridorBoard, (4, n - 1, n - 1) walls followed by (2, n, n) paths, and the walls are also kept as bitboards for
+// the searches.
+struct QuoridorState {
+    int n;
+    int max_walls;
+    int red_x, red_y, blue_x, blue_y;
+    int red_walls, blue_walls;
+    int red_goal, blue_goal;
+    bool is_flipped;
+    bool draw;
+    uint64_t zobrist;
+    uint64_t zobrist_flipped;
+
+    std::vector<int16_t> buffer;
+    // shortestPathActions of the current position, computed on the first call after a change
+    std::array<double, 12> pawn_dists;
+    bool pawn_dists_cached;
+    QuoridorMapInfo map;
+    std::shared_ptr<const ZobristTable> table;
+    std::shared_ptr<const HistoryNode> history;
+
+    explicit QuoridorState(int n)
+            : n(n), max_walls((n + 1) * (n + 1) / 10),
+              red_x(n / 2 + 1 - n % 2), red_y(0), blue_x(n / 2 - 1 + n % 2), blue_y(n - 1),
+              red_walls(max_walls), blue_walls(max_walls), red_goal(n - 1), blue_goal(0),
+              is_flipped(false), draw(false),
+              buffer(4 * (n - 1) * (n - 1) + 2 * n * n, 0), pawn_dists_cached(false),
+              table(ZobristTable::of(n, max_walls)) {
+        QuoridorMapInfo::checkSize(n - 1);
+        std::fill(legalVWalls(), legalVWalls() + 2 * wallsSize(), 1);
+        map = QuoridorMapInfo(vwalls(), hwalls(), n - 1);
+        setPaths();
+        computeZobrist();
+    }
+
+    int wallsSize() const { return (n - 1) * (n - 1); }
+
+    int actionSize() const { return 12 + 2 * wallsSize(); }
+
+    int16_t *vwalls() { return buffer.data(); }
+
+    int16_t *hwalls() { return buffer.data() + wallsSize(); }
+
+    int16_t *legalVWalls() { return buffer.data() + 2 * wallsSize(); }
+
+    int16_t *legalHWalls() { return buffer.data() + 3 * wallsSize(); }
+
+    int16_t *pathsRed() { return buffer.data() + 4 * wallsSize(); }
+
+    int16_t *pathsBlue() { return buffer.data() + 4 * wallsSize() + n * n; }
+
+    int wallsLeft(int player) const { return player == 1 ? red_walls : blue_walls; }
+
+    void computeZobrist() {
+        const ZobristTable &t = *table;
+        int last = n - 1;
+        int s = wallsSize();
+        zobrist = t.red[red_x * n + red_y] ^ t.blue[blue_x * n + blue_y] ^
+                  t.red_walls[red_walls] ^ t.blue_walls[blue_walls];
+        zobrist_flipped = t.blue[(last - red_x) * n + last - red_y] ^ t.red[(last - blue_x) * n + last - blue_y] ^
+                          t.blue_walls[red_walls] ^ t.red_walls[blue_walls];
+        for (int k = 0; k < s; ++k) {
+            if (vwalls()[k] == 1) {
+                zobrist ^= t.vwalls[k];
+                zobrist_flipped ^= t.vwalls[s - 1 - k];
+            }
+            if (hwalls()[k] == 1) {
+                zobrist ^= t.hwalls[k];
+                zobrist_flipped ^= t.hwalls[s - 1 - k];
+            }
         }
-        // check east neighbor
-        if (!hasVWE(vwalls, n.x, n.y) && (path[n.x + 1][n.y] > path[n.x][n.y] + 1)) {
-            q.push(QNode(n.x + 1, n.y));
-//            std::cout << "Add: " <<  n.x+1 << ' '<<  n.y << '\n';
-            path[n.x + 1][n.y] = path[n.x][n.y] + 1;
+        if (draw) {
+            zobrist ^= t.draw;
+            zobrist_flipped ^= t.draw;
         }
-        // check west neighbor
-        if (!hasVWE(vwalls, n.x - 1, n.y) && (path[n.x - 1][n.y] > path[n.x][n.y] + 1)) {
-            q.push(QNode(n.x - 1, n.y));
-//            std::cout << "Add: " <<  n.x << ' '<<  n.y+1 << '\n';
-            path[n.x - 1][n.y] = path[n.x][n.y] + 1;
+    }
+
+    void setPaths() {
+        FlatGrid red{pathsRed(), n};
+        FlatGrid blue{pathsBlue(), n};
+        setPathMatrix(map, n - 1, red);
+        setPathMatrix(map, 0, blue);
+    }
+
+    void addToHistory() {
+        int count = 1;
+        for (const HistoryNode *node = history.get(); node != nullptr; node = node->parent.get()) {
+            if (node->key == zobrist) {
+                count = node->count + 1;
+                break;
+            }
+        }
+        history = std::make_shared<const HistoryNode>(HistoryNode{zobrist, count, history});
+
+        if (count > 2 && !draw) {
+            draw = true;
+            zobrist ^= table->draw;
+            zobrist_flipped ^= table->draw;
         }
     }
+
+    // The action of the flipped state matching action
+    int convertAction(int action) const {
+        if (action < 12)
+            return action ^ 1;
+        int s = wallsSize();
+        int shift = action < 12 + s ? 12 : 12 + s;
+        return shift + s - 1 - (action - shift);
+    }
+
+    void move(int player, int dx, int dy) {
+        const ZobristTable &t = *table;
+        int &x = player == 1 ? red_x : blue_x;
+        int &y = player == 1 ? red_y : blue_y;
+        // coordinates in the flipped state
+        int fx = n - 1 - x;
+        int fy = n - 1 - y;
+        const std::vector<uint64_t> &keys = player == 1 ? t.red : t.blue;
+        const std::vector<uint64_t> &flipped_keys = player == 1 ? t.blue : t.red;
+        zobrist ^= keys[x * n + y] ^ keys[(x + dx) * n + y + dy];
+        zobrist_flipped ^= flipped_keys[fx * n + fy] ^ flipped_keys[(fx - dx) * n + fy - dy];
+        x += dx;
+        y += dy;
+    }
+
+    void placeWall(int player, int x, int y, bool is_vertical) {
+        const ZobristTable &t = *table;
+        int &walls = player == 1 ? red_walls : blue_walls;
+        const std::vector<uint64_t> &keys = player == 1 ? t.red_walls : t.blue_walls;
+        const std::vector<uint64_t> &flipped_keys = player == 1 ? t.blue_walls : t.red_walls;
+        zobrist ^= keys[walls] ^ keys[walls - 1];
+        zobrist_flipped ^= flipped_keys[walls] ^ flipped_keys[walls - 1];
+        walls -= 1;
+
+        int k = x * (n - 1) + y;
+        const std::vector<uint64_t> &wall_keys = is_vertical ? t.vwalls : t.hwalls;
+        zobrist ^= wall_keys[k];
+        zobrist_flipped ^= wall_keys[wallsSize() - 1 - k];
+        if (is_vertical) {
+            vwalls()[k] = 1;
+            map.setVWall(x, y, true);
+        } else {
+            hwalls()[k] = 1;
+            map.setHWall(x, y, true);
+        }
+    }
+
+    // Plays action for player, as QuoridorBoard.executeAction
+    void step(int player, int action) {
+        addToHistory();
+        pawn_dists_cached = false;
+        if (player == -1)
+            action = convertAction(action);
+
+        int s = wallsSize();
+        bool moved = action < 12;
+        int from_x = player == 1 ? red_x : blue_x;
+        int from_y = player == 1 ? red_y : blue_y;
+        if (moved) {
+            move(player, PAWN_DX[action], PAWN_DY[action]);
+        } else {
+            // The number of walls left only decreases, so no position before a wall placement can happen again
+            history.reset();
+            bool is_vertical = action < 12 + s;
+            int k = is_vertical ? action - 12 : action - 12 - s;
+            placeWall(player, k / (n - 1), k % (n - 1), is_vertical);
+
+            // pawn moves leave the paths unchanged
+            FlatGrid red{pathsRed(), n};
+            FlatGrid blue{pathsBlue(), n};
+            repairPathMatrix(map, k / (n - 1), k % (n - 1), is_vertical, red);
+            repairPathMatrix(map, k / (n - 1), k % (n - 1), is_vertical, blue);
+        }
+
+        if (red_walls > 0 || blue_walls > 0)
+            updateLegalWalls(player, moved, from_x, from_y);
+    }
+
+    // Updates the legal walls after an action of player, testing again only the walls whose legality may have
+    // changed. (from_x, from_y) is the previous position of the pawn of player if it moved.
+    void updateLegalWalls(int player, bool moved, int from_x, int from_y) {
+        int px = player == 1 ? red_x : blue_x;
+        int py = player == 1 ? red_y : blue_y;
+        int pgy = player == 1 ? red_goal : blue_goal;
+        int ox = player == 1 ? blue_x : red_x;
+        int oy = player == 1 ? blue_y : red_y;
+        int ogy = player == 1 ? blue_goal : red_goal;
+        FlatGrid legal_v{legalVWalls(), n - 1};
+        FlatGrid legal_h{legalHWalls(), n - 1};
+        if (moved)
+            setWallActionsAfterMove(px, py, n / 2, pgy, ox, oy, n / 2, ogy, from_x, from_y, map, legal_v, legal_h);
+        else
+            setWallActionsAfterWall(px, py, n / 2, pgy, ox, oy, n / 2, ogy, map, legal_v, legal_h);
+    }
+
+    // Writes the valid actions of player in actions[0:actionSize()]
+    void validActions(int player, int16_t *actions) {
+        std::fill(actions, actions + actionSize(), 0);
+        if (player == 1)
+            setPawnActions(red_x, red_y, blue_x, blue_y, map, actions);
+        else
+            setPawnActions(blue_x, blue_y, red_x, red_y, map, actions);
+        if (wallsLeft(player) > 0)
+            std::copy(legalVWalls(), legalVWalls() + 2 * wallsSize(), actions + 12);
+    }
+
+    // The result of the game for player, as QuoridorBoard.getGameEnded: 1 if player won, -1 if player lost,
+    // -1e-3 for a draw and 0 if the game has not ended
+    double gameEnded(int player) const {
+        if (red_y == red_goal)
+            return player;
+        if (blue_y == blue_goal)
+            return -player;
+        if (draw)
+            return -1e-3;
+        return 0;
+    }
+
+    // The outcome for red to move of the pawn race left when both players are out of walls, as gameEnded(1): 1 if
+    // red can force a win, -1 if blue can and -1e-3 if neither can. 0 while any walls are left or once the game
+    // has ended. Draws by repetitions already played are not foreseen.
+    double raceResult() const {
+        if (red_walls > 0 || blue_walls > 0 || gameEnded(1) != 0)
+            return 0;
+        int outcome = RaceTable::of(map, n, red_goal, blue_goal)->outcome(0, red_x, red_y, blue_x, blue_y);
+        return outcome != 0 ? outcome : -1e-3;
+    }
+
+    // How close to its goal each valid pawn action of red brings it, 0 for invalid actions. The 12 values are
+    // kept until the state changes.
+    const double *shortestPathActions() {
+        if (pawn_dists_cached)
+            return pawn_dists.data();
+        int16_t actions[12] = {0};
+        setPawnActions(red_x, red_y, blue_x, blue_y, map, actions);
+        double max_dist = n * n + 1;
+        for (int i = 0; i < 12; ++i) {
+            pawn_dists[i] = 0;
+            if (actions[i] == 1)
+                pawn_dists[i] = (max_dist - pathsRed()[(red_x + PAWN_DX[i]) * n + red_y + PAWN_DY[i]]) / max_dist;
+        }
+        pawn_dists_cached = true;
+        return pawn_dists.data();
+    }
+
+    // Writes the encoding of QuoridorBoard.getBoard: pawn planes (2, n, n), wall planes (2, n - 1, n - 1) and the
+    // 17 values
+    template<class T, class V>
+    void encode(T *boards, T *walls, V *values) {
+        std::fill(boards, boards + 2 * n * n, 0);
+        boards[red_x * n + red_y] = 1;
+        boards[n * n + blue_x * n + blue_y] = 1;
+        std::copy(vwalls(), vwalls() + 2 * wallsSize(), walls);
+
+        const double *dists = shortestPathActions();
+        std::copy(dists, dists + 12, values);
+        double max_dist = n * n + 1;
+        values[12] = (double) red_walls / max_walls;
+        values[13] = (double) blue_walls / max_walls;
+        values[14] = (max_dist - pathsRed()[red_x * n + red_y]) / max_dist;
+        values[15] = (max_dist - pathsBlue()[blue_x * n + blue_y]) / max_dist;
+        values[16] = draw;
+    }
+
+    // Turns the state around, so that blue plays as red
+    void flip() {
+        is_flipped = !is_flipped;
+        pawn_dists_cached = false;
+        std::swap(red_x, blue_x);
+        std::swap(red_y, blue_y);
+        red_x = n - 1 - red_x;
+        red_y = n - 1 - red_y;
+        blue_x = n - 1 - blue_x;
+        blue_y = n - 1 - blue_y;
+        std::swap(red_walls, blue_walls);
+        std::swap(zobrist, zobrist_flipped);
+
+        // rotating every plane by 180 degrees reverses it
+        for (int i = 0; i < 4; ++i)
+            std::reverse(vwalls() + i * wallsSize(), vwalls() + (i + 1) * wallsSize());
+        // which also swaps the red and blue paths
+        std::reverse(pathsRed(), pathsRed() + 2 * n * n);
+        map = QuoridorMapInfo(vwalls(), hwalls(), n - 1);
+    }
+};
+
+using StatePickle = std::tuple<int, int, int, int, int, int, int, bool, bool, uint64_t, uint64_t, py::bytes,
+        std::vector<std::tuple<uint64_t, int>>>;
+
+inline StatePickle pickleState(const QuoridorState &state) {
+    // the history from the oldest entry
+    std::vector<std::tuple<uint64_t, int>> history;
+    for (const HistoryNode *node = state.history.get(); node != nullptr; node = node->parent.get())
+        history.emplace_back(node->key, node->count);
+    std::reverse(history.begin(), history.end());
+    return StatePickle(state.n, state.red_x, state.red_y, state.blue_x, state.blue_y,
+                       state.red_walls, state.blue_walls, state.is_flipped, state.draw,
+                       state.zobrist, state.zobrist_flipped,
+                       py::bytes((const char *) state.buffer.data(), state.buffer.size() * sizeof(int16_t)),
+                       history);
 }
 
-inline std::tuple<std::vector<std::vector<int>>, std::vector<std::vector<int>>> getPathMatrices(
-        const std::vector<std::vector<int>> &vwalls,
-        const std::vector<std::vector<int>> &hwalls) {
-    int board_size = (int) hwalls.size() + 1;
-    int max = board_size * board_size + 1;
-    std::vector<std::vector<int>> path_red(board_size, std::vector<int>(board_size, max));
-    std::vector<std::vector<int>> path_blue(board_size, std::vector<int>(board_size, max));
-    queue<QNode> q;
+inline QuoridorState unpickleState(const StatePickle &t) {
+    QuoridorState state(std::get<0>(t));
+    std::tie(std::ignore, state.red_x, state.red_y, state.blue_x, state.blue_y,
+             state.red_walls, state.blue_walls, state.is_flipped, state.draw,
+             state.zobrist, state.zobrist_flipped, std::ignore, std::ignore) = t;
+    std::string buffer = std::get<11>(t);
+    if (buffer.size() != state.buffer.size() * sizeof(int16_t))
+        throw std::invalid_argument("buffer size does not match the board size");
+    std::memcpy(state.buffer.data(), buffer.data(), buffer.size());
+    state.map = QuoridorMapInfo(state.vwalls(), state.hwalls(), state.n - 1);
+    for (const auto &entry : std::get<12>(t))
+        state.history = std::make_shared<const HistoryNode>(
+                HistoryNode{std::get<0>(entry), std::get<1>(entry), state.history});
+    return state;
+}
 
-    for (int i = 0; i < board_size; ++i) {
-        path_red[i][board_size - 1] = 0;
-        QNode n(i, board_size - 1);
-        q.push(n);
+// A read-only (shape) view of data, owned by the state self and kept alive by the view
+template<class T>
+inline py::array readOnlyView(py::object self, std::vector<py::ssize_t> shape, const T *data) {
+    py::array view(py::dtype::of<T>(), shape, data, self);
+    py::detail::array_proxy(view.ptr())->flags &= ~py::detail::npy_api::NPY_ARRAY_WRITEABLE_;
+    return view;
+}
+
+// A (shape) int16 view of the buffer of state. The view is read-only, since writing to it would leave the wall
+// bitboards out of date.
+inline py::array bufferView(py::object self, std::vector<py::ssize_t> shape, size_t offset) {
+    QuoridorState &state = self.cast<QuoridorState &>();
+    return readOnlyView(self, shape, state.buffer.data() + offset);
+}
+
+using Float32Array = py::array_t<float, py::array::c_style>;
+
+// Writes the encodings of states in the first rows of the float32 arrays boards (B, 2, n, n), walls
+// (B, 2, n - 1, n - 1) and values (B, 17), as QuoridorState.encode
+inline void encodeStates(const std::vector<QuoridorState *> &states,
+                         Float32Array boards, Float32Array walls, Float32Array values) {
+    if (states.empty())
+        return;
+    int n = states[0]->n;
+    py::ssize_t k = (py::ssize_t) states.size();
+    if (boards.ndim() != 4 || boards.shape(0) < k || boards.shape(1) != 2 || boards.shape(2) != n ||
+        walls.ndim() != 4 || walls.shape(0) < k || walls.shape(1) != 2 || walls.shape(2) != n - 1 ||
+        values.ndim() != 2 || values.shape(0) < k || values.shape(1) != 17)
+        throw std::invalid_argument("the arrays don't match the number of states or their size");
+    for (QuoridorState *state : states)
+        if (state->n != n)
+            throw std::invalid_argument("the states have different sizes");
+
+    float *boards_data = boards.mutable_data();
+    float *walls_data = walls.mutable_data();
+    float *values_data = values.mutable_data();
+    py::gil_scoped_release release;
+    for (py::ssize_t i = 0; i < k; ++i)
+        states[i]->encode(boards_data + i * 2 * n * n, walls_data + i * 2 * (n - 1) * (n - 1), values_data + i * 17);
+}
+
+inline void bindQuoridorState(py::module &module) {
+    py::class_<QuoridorState>(module, "QuoridorState",
+                              "The native state of a game, wrapped by QuoridorBoard")
+            .def(py::init<int>(), py::arg("n"))
+            .def_readonly("n", &QuoridorState::n)
+            .def_readonly("max_walls", &QuoridorState::max_walls)
+            .def_readonly("red_walls", &QuoridorState::red_walls)
+            .def_readonly("blue_walls", &QuoridorState::blue_walls)
+            .def_readonly("red_goal", &QuoridorState::red_goal)
+            .def_readonly("blue_goal", &QuoridorState::blue_goal)
+            .def_readonly("is_flipped", &QuoridorState::is_flipped)
+            .def_readonly("draw", &QuoridorState::draw)
+            .def_readonly("zobrist", &QuoridorState::zobrist)
+            .def_readonly("zobrist_flipped", &QuoridorState::zobrist_flipped)
+            .def_property_readonly("red_position", [](const QuoridorState &s) {
+                return std::make_tuple(s.red_x, s.red_y);
+            })
+            .def_property_readonly("blue_position", [](const QuoridorState &s) {
+                return std::make_tuple(s.blue_x, s.blue_y);
+            })
+            .def_property_readonly("walls", [](py::object self) {
+                int n = self.cast<QuoridorState &>().n;
+                return bufferView(self, {4, n - 1, n - 1}, 0);
+            }, "v_walls, h_walls, legal_vwalls and legal_hwalls as a read-only (4, n - 1, n - 1) array")
+            .def_property_readonly("paths", [](py::object self) {
+                QuoridorState &s = self.cast<QuoridorState &>();
+                return bufferView(self, {2, s.n, s.n}, 4 * s.wallsSize());
+            }, "paths_red and paths_blue as a read-only (2, n, n) array")
+            .def("step", [](QuoridorState &s, int player, int action) {
+                if (action < 0 || action >= s.actionSize())
+                    throw py::index_error("action out of range");
+                py::gil_scoped_release release;
+                s.step(player, action);
+            }, py::arg("player"), py::arg("action"), "Plays action for player")
+            .def("valid_actions", [](QuoridorState &s, int player) {
+                py::array_t<int16_t> actions(s.actionSize());
+                s.validActions(player, actions.mutable_data());
+                return actions;
+            }, py::arg("player"), "The np.int16 mask of the valid actions of player")
+            .def("game_ended", [](const QuoridorState &s, int player) -> py::object {
+                double res = s.gameEnded(player);
+                if (res == 1 || res == -1 || res == 0)
+                    return py::int_((int) res);
+                return py::float_(res);
+            }, py::arg("player"), "0 if the game has not ended, 1 if player won, -1 if player lost, -1e-3 for a draw")
+            .def("clone", [](const QuoridorState &s) { return QuoridorState(s); }, "A copy sharing the history")
+            .def("flip", &QuoridorState::flip, "Turns the state around, so that blue plays as red")
+            .def("encode", [](QuoridorState &s) {
+                py::array_t<int64_t> boards({2, s.n, s.n});
+                py::array_t<int64_t> walls({2, s.n - 1, s.n - 1});
+                py::array_t<double> values(17);
+                s.encode(boards.mutable_data(), walls.mutable_data(), values.mutable_data());
+                return py::make_tuple(boards, walls, values);
+            }, "The boards, walls and values arrays of QuoridorBoard.getBoard")
+            .def("race_result", &QuoridorState::raceResult,
+                 "The outcome for red to move of the pawn race left once both players are out of walls, as "
+                 "game_ended(1), 0 while any walls are left")
+            .def("shortest_path_actions", [](QuoridorState &state) {
+                // copied, the cache changes with the state
+                return py::array_t<double>(12, state.shortestPathActions());
+            }, "How close to its goal each valid pawn action of red brings it, 0 for invalid actions")
+            .def(py::pickle(&pickleState, &unpickleState));
+
+    // the arrays are not converted, so that the encodings are written in them
+    module.def("encodeStates", &encodeStates,
+               "Writes the encodings of a list of QuoridorStates in the first rows of float32 arrays",
+               py::arg("states"), py::arg("boards").noconvert(), py::arg("walls").noconvert(),
+               py::arg("values").noconvert());
+}
+
+
+/*
+ * Native MCTS
+ */
+
+const double MCTS_EPS = 1e-8;
+
+struct MCTSEdge {
+    int action;
+    float p;  // prior
+    int n;  // visits, including the pending virtual losses
+    double q;  // mean value for the player taking the action
+    int child;  // node of the board reached by the action, -1 if unknown
+};
+
+struct MCTSNode {
+    uint64_t key;  // zobrist key of the canonical board
+    int ns;  // visits
+    std::vector<MCTSEdge> edges;  // one per valid action
+};
+
+// A leaf waiting for its evaluation: its state and the (node, edge) path from the root
+struct MCTSLeaf {
+    QuoridorState state;
+    std::vector<std::pair<int, int>> path;
+};
+
+// The search tree of alphazero_general/MCTSNative.py. The boards are the canonical QuoridorStates, identified by
+// their zobrist key, and the statistics live on the edges of their nodes. Descents run without the GIL, which is
+// taken back only to evaluate the encodings of a batch of leaves with a Python callback.
+class QuoridorMCTS {
+public:
+    int action_size;
+    double cpuct, cpuct_base, cpuct_mult;
+    double dirichlet_alpha, eps;
+    int batch_size;
+    int virtual_loss;  // 0 with a batch of 1, whose simulations are backed up one by one as MCTSQuoridor.search does
+    bool endgame_solver;  // treat the boards below the root where both players are out of walls as terminal
+    long masked;  // expansions where the network gave no probability to the valid actions
+
+    std::vector<MCTSNode> nodes;
+    std::unordered_map<uint64_t, int> index;  // node of each zobrist key
+    std::vector<double> cpuct_table;  // cpuct for a board visited ns times
+    std::mt19937_64 rng;
+
+    QuoridorMCTS(int action_size, double cpuct, double cpuct_base, double cpuct_mult,
+                 double dirichlet_alpha, double eps, int batch_size, int virtual_loss, bool endgame_solver,
+                 uint64_t seed)
+            : action_size(action_size), cpuct(cpuct), cpuct_base(cpuct_base), cpuct_mult(cpuct_mult),
+              dirichlet_alpha(dirichlet_alpha), eps(eps), batch_size(std::max(batch_size, 1)),
+              virtual_loss(this->batch_size > 1 ? virtual_loss : 0), endgame_solver(endgame_solver), masked(0), rng(seed) {}
+
+    void clear() {
+        nodes.clear();
+        index.clear();
     }
-    calculatePathMatrix(vwalls, hwalls, path_red, q);
 
-    for (int i = 0; i < board_size; ++i) {
-        path_blue[i][0] = 0;
-        QNode n(i, 0);
-        q.push(n);
+    double cpuctSchedule(int ns) {
+        while ((int) cpuct_table.size() <= ns)
+            cpuct_table.push_back(
+                    cpuct_mult * std::log((1 + cpuct_table.size() + cpuct_base) / cpuct_base) + cpuct);
+        return cpuct_table[ns];
     }
-    calculatePathMatrix(vwalls, hwalls, path_blue, q);
 
-    return {path_red, path_blue};
+    // The edge of node with the highest upper confidence bound
+    int selectEdge(const MCTSNode &node) {
+        double c = cpuctSchedule(node.ns);
+        double sqrt_ns = std::sqrt((double) node.ns);
+        double sqrt_ns_eps = std::sqrt(node.ns + MCTS_EPS);
+        double best = -std::numeric_limits<double>::infinity();
+        int best_edge = -1;
+        for (int i = 0; i < (int) node.edges.size(); ++i) {
+            const MCTSEdge &e = node.edges[i];
+            double u;
+            if (e.n > 0)
+                u = e.q + c * e.p * sqrt_ns / (1 + e.n);
+            else
+                u = c * e.p * sqrt_ns_eps;  // Q = 0 ?
+            if (u > best) {
+                best = u;
+                best_edge = i;
+            }
+        }
+        return best_edge;
+    }
+
+    void addVirtualLoss(int node, int edge) {
+        if (virtual_loss == 0)
+            return;
+        MCTSEdge &e = nodes[node].edges[edge];
+        if (e.n > 0)
+            e.q = (e.n * e.q - virtual_loss) / (e.n + virtual_loss);
+        else
+            e.q = -1.;
+        e.n += virtual_loss;
+        nodes[node].ns += virtual_loss;
+    }
+
+    void revertVirtualLoss(const std::vector<std::pair<int, int>> &path) {
+        if (virtual_loss == 0)
+            return;
+        for (auto it = path.rbegin(); it != path.rend(); ++it) {
+            MCTSEdge &e = nodes[it->first].edges[it->second];
+            int n = e.n - virtual_loss;
+            e.q = n > 0 ? (e.n * e.q + virtual_loss) / n : 0.;
+            e.n = n;
+            nodes[it->first].ns -= virtual_loss;
+        }
+    }
+
+    // Removes the virtual losses of path and propagates v, the value of its last edge for the player who took it
+    void backup(const std::vector<std::pair<int, int>> &path, double v) {
+        for (auto it = path.rbegin(); it != path.rend(); ++it) {
+            MCTSEdge &e = nodes[it->first].edges[it->second];
+            int n = e.n - virtual_loss;
+            e.q = n > 0 ? (e.n * e.q + virtual_loss + v) / (n + 1) : v;
+            e.n = n + 1;
+            nodes[it->first].ns += 1 - virtual_loss;
+            v = -v;
+        }
+    }
+
+    // Adds the node of the leaf state with the policy pi returned by the network. When both players have no walls
+    // left only the pawn actions getting closest to the goal keep their prior, and the priors get Dirichlet noise.
+    int expand(QuoridorState &state, const float *pi) {
+        std::vector<int16_t> valids(action_size);
+        state.validActions(1, valids.data());
+        std::vector<char> allowed(valids.begin(), valids.end());
+        if (state.red_walls == 0 && state.blue_walls == 0) {
+            const double *dists = state.shortestPathActions();
+            double best = *std::max_element(dists, dists + 12);
+            std::fill(allowed.begin(), allowed.end(), 0);
+            for (int a = 0; a < 12; ++a)
+                allowed[a] = dists[a] == best;
+        }
+
+        MCTSNode node{state.zobrist, 0, {}};
+        double sum = 0;
+        int num_allowed = 0;
+        for (int a = 0; a < action_size; ++a) {
+            if (valids[a] != 1 && !allowed[a])
+                continue;
+            float p = allowed[a] ? pi[a] : 0.f;
+            node.edges.push_back(MCTSEdge{a, p, 0, 0., -1});
+            sum += p;
+            num_allowed += allowed[a];
+        }
+
+        std::gamma_distribution<double> gamma(dirichlet_alpha, 1.);
+        std::vector<double> noise(node.edges.size(), 0.);
+        double noise_sum = 0;
+        for (size_t i = 0; i < node.edges.size(); ++i) {
+            if (allowed[node.edges[i].action]) {
+                noise[i] = gamma(rng);
+                noise_sum += noise[i];
+            }
+        }
+        if (sum <= 0)
+            masked += 1;
+        for (size_t i = 0; i < node.edges.size(); ++i) {
+            MCTSEdge &e = node.edges[i];
+            if (!allowed[e.action])
+                continue;
+            // if all the actions were masked make them equally probable
+            double p = sum > 0 ? e.p / sum : 1. / num_allowed;
+            double n = noise_sum > 0 ? noise[i] / noise_sum : 1. / num_allowed;
+            e.p = (float) ((1 - eps) * p + eps * n);
+        }
+
+        nodes.push_back(std::move(node));
+        index[state.zobrist] = (int) nodes.size() - 1;
+        return (int) nodes.size() - 1;
+    }
+
+    // Makes the board of root the root of the tree, dropping the nodes that can't be reached from it
+    void prune(const QuoridorState &root) {
+        auto it = index.find(root.zobrist);
+        if (it == index.end()) {
+            clear();
+            return;
+        }
+
+        std::vector<int> remap(nodes.size(), -1);
+        std::vector<int> frontier{it->second};
+        remap[it->second] = 0;
+        int size = 1;
+        std::vector<int> order{it->second};
+        while (!frontier.empty()) {
+            int id = frontier.back();
+            frontier.pop_back();
+            for (const MCTSEdge &e : nodes[id].edges) {
+                if (e.child >= 0 && remap[e.child] < 0) {
+                    remap[e.child] = size++;
+                    order.push_back(e.child);
+                    frontier.push_back(e.child);
+                }
+            }
+        }
+
+        std::vector<MCTSNode> kept;
+        kept.reserve(size);
+        index.clear();
+        for (int id : order) {
+            kept.push_back(std::move(nodes[id]));
+            for (MCTSEdge &e : kept.back().edges)
+                e.child = e.child >= 0 ? remap[e.child] : -1;
+            index[kept.back().key] = (int) kept.size() - 1;
+        }
+        nodes = std::move(kept);
+    }
+
+    // Runs num_sims simulations from the canonical state root, evaluating the leaves with
+    // evaluate(boards, walls, values) -> (pis, vs) on float32 encodings of up to batch_size boards.
+    // Returns the visits of every action of root.
+    py::array_t<int> search(const QuoridorState &root, int num_sims, const py::function &evaluate) {
+        int n = root.n;
+        py::array_t<float> boards({batch_size, 2, n, n});
+        py::array_t<float> walls({batch_size, 2, n - 1, n - 1});
+        py::array_t<float> values({batch_size, 17});
+        float *boards_data = boards.mutable_data();
+        float *walls_data = walls.mutable_data();
+        float *values_data = values.mutable_data();
+
+        {
+            py::gil_scoped_release release;
+            std::vector<MCTSLeaf> leaves;
+            std::unordered_set<uint64_t> pending;
+            std::vector<float> pis;
+            std::vector<float> vs;
+
+            for (int sim = 0; sim < num_sims; sim += batch_size) {
+                leaves.clear();
+                pending.clear();
+                for (int b = 0; b < std::min(batch_size, num_sims - sim); ++b)
+                    descend(root, leaves, pending);
+                if (leaves.empty())
+                    continue;
+
+                int k = (int) leaves.size();
+                for (int i = 0; i < k; ++i)
+                    leaves[i].state.encode(boards_data + i * 2 * n * n, walls_data + i * 2 * (n - 1) * (n - 1),
+                                           values_data + i * 17);
+                try {
+                    py::gil_scoped_acquire acquire;
+                    py::slice rows(0, k, 1);
+                    py::tuple res = evaluate(boards[rows], walls[rows], values[rows]);
+                    auto p = py::array_t<float, py::array::c_style | py::array::forcecast>::ensure(res[0]);
+                    auto v = py::array_t<float, py::array::c_style | py::array::forcecast>::ensure(res[1]);
+                    if (!p || !v || p.size() != (py::ssize_t) k * action_size || v.size() != k)
+                        throw std::runtime_error("evaluate must return the policies and values of the boards");
+                    pis.assign(p.data(), p.data() + p.size());
+                    vs.assign(v.data(), v.data() + v.size());
+                } catch (...) {
+                    // the tree may be reused for the next move, so it must not keep the virtual losses
+                    for (const MCTSLeaf &leaf : leaves)
+                        revertVirtualLoss(leaf.path);
+                    throw;
+                }
+
+                for (int i = 0; i < k; ++i) {
+                    int id = expand(leaves[i].state, pis.data() + i * action_size);
+                    if (!leaves[i].path.empty()) {
+                        auto last = leaves[i].path.back();
+                        nodes[last.first].edges[last.second].child = id;
+                    }
+                    backup(leaves[i].path, -vs[i]);
+                }
+            }
+        }
+
+        py::array_t<int> counts(action_size);
+        std::fill(counts.mutable_data(), counts.mutable_data() + action_size, 0);
+        auto it = index.find(root.zobrist);
+        if (it != index.end())
+            for (const MCTSEdge &e : nodes[it->second].edges)
+                counts.mutable_data()[e.action] = e.n;
+        return counts;
+    }
+
+    // Walks down from root to a terminal board, whose value is backed up, or to a leaf, added to leaves unless it
+    // is already pending evaluation. The edges walked through get a virtual loss. With endgame_solver the boards
+    // below the root where both players are out of walls are terminal, with the outcome of the race.
+    void descend(const QuoridorState &root, std::vector<MCTSLeaf> &leaves, std::unordered_set<uint64_t> &pending) {
+        QuoridorState state = root;
+        std::vector<std::pair<int, int>> path;
+        while (true) {
+            double ended = state.gameEnded(1);
+            if (ended == 0 && endgame_solver && !path.empty())
+                ended = state.raceResult();
+            if (ended != 0) {
+                backup(path, -ended);
+                return;
+            }
+
+            auto it = index.find(state.zobrist);
+            if (it == index.end()) {
+                if (pending.count(state.zobrist)) {
+                    revertVirtualLoss(path);
+                } else {
+                    pending.insert(state.zobrist);
+                    leaves.push_back(MCTSLeaf{std::move(state), std::move(path)});
+                }
+                return;
+            }
+
+            int id = it->second;
+            if (!path.empty())
+                nodes[path.back().first].edges[path.back().second].child = id;
+            int edge = selectEdge(nodes[id]);
+            addVirtualLoss(id, edge);
+            path.emplace_back(id, edge);
+
+            // the next canonical board
+            state.step(1, nodes[id].edges[edge].action);
+            state.flip();
+        }
+    }
+};
+
+inline void bindQuoridorMCTS(py::module &module) {
+    py::class_<QuoridorMCTS>(module, "QuoridorMCTS", "The native search tree of MCTSNative")
+            .def(py::init<int, double, double, double, double, double, int, int, bool, uint64_t>(),
+                 py::arg("action_size"), py::arg("cpuct"), py::arg("cpuct_base"), py::arg("cpuct_mult"),
+                 py::arg("dirichlet_alpha"), py::arg("eps"), py::arg("batch_size"), py::arg("virtual_loss"),
+                 py::arg("endgame_solver"), py::arg("seed"))
+            .def_readonly("masked", &QuoridorMCTS::masked)
+            .def("__len__", [](const QuoridorMCTS &m) { return m.nodes.size(); })
+            .def("clear", &QuoridorMCTS::clear)
+            .def("prune", &QuoridorMCTS::prune, py::arg("root"))
+            .def("search", &QuoridorMCTS::search, py::arg("root"), py::arg("num_sims"), py::arg("evaluate"));
 }
 
 
@@ -622,4 +1753,8 @@ inline PYBIND11_MODULE(QuoridorUtils, module) {
     module.def("getValidActions", &getValidActions, "");
     module.def("updateWallActions", &updateWallActions, "");
     module.def("getPathMatrices", &getPathMatrices, "");
+
+    module.attr("MAX_BOARD_SIZE") = MAX_BOARD_SIZE;
+    bindQuoridorState(module);
+    bindQuoridorMCTS(module);
 }
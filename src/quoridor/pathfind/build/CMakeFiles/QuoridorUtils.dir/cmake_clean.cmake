@@ -0,0 +1,11 @@
+file(REMOVE_RECURSE
+  "CMakeFiles/QuoridorUtils.dir/QuoridorUtils.cpp.o"
+  "CMakeFiles/QuoridorUtils.dir/QuoridorUtils.cpp.o.d"
+  "QuoridorUtils.cpython-311-x86_64-linux-gnu.so"
+  "QuoridorUtils.pdb"
+)
+
+# Per-language clean rules from dependency scanning.
+foreach(lang CXX)
+  include(CMakeFiles/QuoridorUtils.dir/cmake_clean_${lang}.cmake OPTIONAL)
+endforeach()
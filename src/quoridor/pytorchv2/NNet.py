@@ -7,11 +7,13 @@ from tqdm import tqdm
 sys.path.append('../../')
 from alphazero_general.utils import *
 from alphazero_general.NeuralNet import NeuralNet
+from alphazero_general.TrainingData import TrainingData
 
 import torch
 import torch.optim as optim
 
 from .QuoridorBigNNet import QuoridorNNet as qnnet
+from ..QuoridorLogic import BoardEncoder
 
 args = dotdict({
     'lr': 0.001,
@@ -35,6 +37,8 @@ class NNetWrapper(NeuralNet):
         self.nnet = qnnet(game, self.nn_args)
         self.boards, self.walls, self.values = game.getBoardSize()
         self.action_size = game.getActionSize()
+        self.game = game  # applies the symmetries to the training batches
+        self.encoder = BoardEncoder(game.n)  # input buffers of predict_batch
         if self.nn_args.cuda:
             self.nnet.cuda()
 
@@ -43,10 +47,21 @@ class NNetWrapper(NeuralNet):
 
     def train(self, examples):
         """
-        examples: list of examples, each example is of form (board, pi, v)
+        examples: TrainingData, or list of examples, each example is of form (board, pi, v)
         """
+        if not isinstance(examples, TrainingData):
+            examples = TrainingData.fromExamples(examples)
         optimizer = optim.Adam(self.nnet.parameters())
 
+        def toTensors(batch):
+            # runs on the prefetching thread
+            inputs, pis, vs = batch
+            (boards, walls, values), pis = self.game.getSymmetriesBatch(inputs, pis)
+            tensors = [torch.from_numpy(x) for x in (boards, walls, values, pis, vs)]
+            if self.nn_args.cuda:
+                tensors = [x.pin_memory() for x in tensors]
+            return tensors
+
         for epoch in range(self.nn_args.epochs):
             # print('EPOCH ::: ' + str(epoch + 1))
             self.nnet.train()
@@ -55,24 +70,16 @@ class NNetWrapper(NeuralNet):
 
             batch_count = int(len(examples) / self.nn_args.batch_size)
 
-            t = tqdm(range(batch_count), desc='Training Net')
-            for _ in t:
-                sample_ids = np.random.randint(len(examples), size=self.nn_args.batch_size)
-                nn_input, pis, vs = list(zip(*[examples[i] for i in sample_ids]))
-                boards, walls, values = list(zip(*[i for i in nn_input]))
-                boards = torch.FloatTensor(np.array(boards).astype(np.float64))
-                walls = torch.FloatTensor(np.array(walls).astype(np.float64))
-                values = torch.FloatTensor(np.array(values).astype(np.float64))
-                target_pis = torch.FloatTensor(np.array(pis))
-                target_vs = torch.FloatTensor(np.array(vs).astype(np.float64))
-
+            t = tqdm(examples.batches(self.nn_args.batch_size, batch_count, toTensors), total=batch_count,
+                     desc='Training Net')
+            for boards, walls, values, target_pis, target_vs in t:
                 # predict
                 if self.nn_args.cuda:
-                    boards = boards.contiguous().cuda()
-                    walls = walls.contiguous().cuda()
-                    values = values.contiguous().cuda()
-                    target_pis = target_pis.contiguous().cuda()
-                    target_vs = target_vs.contiguous().cuda()
+                    boards = boards.cuda(non_blocking=True)
+                    walls = walls.cuda(non_blocking=True)
+                    values = values.cuda(non_blocking=True)
+                    target_pis = target_pis.cuda(non_blocking=True)
+                    target_vs = target_vs.cuda(non_blocking=True)
 
                 # compute output
                 out_pi, out_v = self.nnet(boards, walls, values)
@@ -94,24 +101,31 @@ class NNetWrapper(NeuralNet):
         """
         board: np array with board
         """
-        board, wall, value = board.getBoard()
+        pi, v = self.predict_batch([board])
+        return pi[0], v[:1]
+
+    def predict_batch(self, boards):
+        """
+        boards: list of boards
+        """
+        return self.predict_encoded(*self.encoder.encode(boards))
+
+    def predict_encoded(self, boards, walls, values):
+        """
+        boards, walls, values: stacked encodings of a batch of boards, used
+        without copying if they are float32 arrays
+        """
         # preparing input
-        board = torch.FloatTensor(board.astype(np.float64))
-        wall = torch.FloatTensor(wall.astype(np.float64))
-        value = torch.FloatTensor(value.astype(np.float64))
+        boards, walls, values = (torch.from_numpy(np.ascontiguousarray(x, np.float32)) for x in (boards, walls, values))
         if self.nn_args.cuda:
-            board = board.contiguous().cuda()
-            wall = wall.contiguous().cuda()
-            value = value.contiguous().cuda()
-        board = board.view(self.boards[2], self.boards[0], self.boards[1])
-        wall = wall.view(self.walls[2], self.walls[0], self.walls[1])
-        value = value.view(self.values)
+            boards = boards.contiguous().cuda()
+            walls = walls.contiguous().cuda()
+            values = values.contiguous().cuda()
         self.nnet.eval()
         with torch.no_grad():
-            pi, v = self.nnet(board, wall, value)
+            pi, v = self.nnet(boards, walls, values)
 
-        # print('PREDICTION TIME TAKEN : {0:03f}'.format(time.time()-start))
-        return torch.exp(pi).data.cpu().numpy()[0], v.data.cpu().numpy()[0]
+        return torch.exp(pi).data.cpu().numpy(), v.data.cpu().numpy()[:, 0]
 
     def loss_pi(self, targets, outputs):
         return -torch.sum(targets * outputs) / targets.size()[0]
@@ -36,6 +36,8 @@ def play_games(n=9,
         'cpuct': 2.5,
         'cpuct_base': 19652,
         'cpuct_mult': 2,
+        'mcts_batch_size': 8,  # Number of MCTS leaves evaluated by the neural network at once.
+        'virtual_loss': 1,
 
         'checkpoint': './temp/',
         'load_model': True,